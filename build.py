@@ -41,7 +41,7 @@ def set_properties(project: Project):
     # Dependencies
     project.depends_on("kombu", "4.0.2")
 
-    project.build_depends_on("sqlalchemy")
+    project.build_depends_on("sqlalchemy", ">=1.4")
     project.build_depends_on("django")
     project.build_depends_on("karellen-sqlite", "~=0.0.0")
     project.build_depends_on("unittest2")
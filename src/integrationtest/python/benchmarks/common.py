@@ -0,0 +1,101 @@
+"""Helpers shared by the benchmarks.
+
+Benchmarks run producers and consumers in separate processes on a
+file-backed SQLite database. Every process sets Django up with :func:`setup`
+and connects like the functional tests, see :class:`BenchmarkCase`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from multiprocessing import Process
+
+from funtests import transport
+
+
+def setup(db_path, settings=None):
+    """Configure Django for the database at `db_path` and the extra
+    ``KOMBU_*`` `settings`."""
+    from django.conf import settings as django_settings
+    django_settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': db_path,
+            },
+        },
+        INSTALLED_APPS=('karellen.kombu.transport.django',),
+        **(settings or {})
+    )
+
+    import django
+    django.setup()
+
+    from karellen.kombu import register_transports
+    register_transports()
+
+
+def migrate(db_path, settings=None):
+    setup(db_path, settings)
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+class BenchmarkCase(transport.TransportCase):
+    """Connection setup of :class:`~funtests.transport.TransportCase` for a
+    benchmark process."""
+
+    transport = 'django'
+    prefix = 'bench'
+
+    def __init__(self, db_path, settings=None, transport_options=None):
+        super(BenchmarkCase, self).__init__()
+        self.db_path = db_path
+        self.settings = settings or {}
+        self.connection_options = {'transport_options': transport_options or {}}
+
+    def before_connect(self):
+        setup(self.db_path, self.settings)
+
+    def connect(self):
+        """Set Django up and return the connection."""
+        self.setUp()
+        if not self.connected:
+            raise RuntimeError(self.skip_test_reason)
+        return self.connection
+
+
+def start(target, *args):
+    # Daemonic, so that failing benchmarks don't wait for stuck processes
+    process = Process(target=target, args=args)
+    process.daemon = True
+    process.start()
+    return process
+
+
+def check(*processes):
+    """Raise if any of `processes` has failed."""
+    for process in processes:
+        if process.exitcode:
+            raise RuntimeError('{0} failed with exit code {1}'.format(
+                process.name, process.exitcode))
+
+
+def wait_ready(process, ready):
+    """Wait for `process` to set the `ready` event, failing if it exits first.
+
+    Processes are set up one after another: SQLite fails concurrent
+    declarations with "database is locked".
+    """
+    while not ready.wait(1):
+        check(process)
+        if not process.is_alive():
+            raise RuntimeError('{0} exited before it was ready'.format(process.name))
+
+
+def join(*processes, timeout=None):
+    """Wait for `processes` to exit, at most `timeout` seconds each."""
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            raise RuntimeError('{0} did not exit within {1} seconds'.format(
+                process.name, timeout))
+        check(process)
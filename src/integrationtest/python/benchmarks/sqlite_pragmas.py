@@ -0,0 +1,69 @@
+"""Compare Django transport throughput on a file-backed SQLite database with
+and without ``KOMBU_SQLITE_PRAGMAS``.
+
+One producer and one consumer process exchange ``-n`` messages concurrently::
+
+    python -m benchmarks.sqlite_pragmas -n 2000
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Event
+
+from .common import BenchmarkCase, join, migrate, start, wait_ready
+
+QUEUE = 'bench'
+
+
+def produce(db_path, settings, n):
+    with BenchmarkCase(db_path, settings).connect() as conn:
+        queue = conn.SimpleQueue(QUEUE)
+        for i in range(n):
+            queue.put({'i': i})
+        queue.close()
+
+
+def consume(db_path, settings, n, ready):
+    with BenchmarkCase(db_path, settings).connect() as conn:
+        queue = conn.SimpleQueue(QUEUE)
+        ready.set()
+        for _ in range(n):
+            queue.get(timeout=60).ack()
+        queue.close()
+
+
+def run(pragmas, n):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.sqlite3')
+        settings = {'KOMBU_SQLITE_PRAGMAS': pragmas}
+        join(start(migrate, db_path, settings))
+
+        ready = Event()
+        consumer = start(consume, db_path, settings, n, ready)
+        wait_ready(consumer, ready)
+
+        time_start = time.time()
+        join(consumer, start(produce, db_path, settings, n))
+        return n / (time.time() - time_start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000, help='number of messages')
+    args = parser.parse_args()
+
+    results = {
+        'messages': args.n,
+        'default_msgs_per_sec': run(None, args.n),
+        'tuned_msgs_per_sec': run(True, args.n),
+    }
+    results['speedup'] = results['tuned_msgs_per_sec'] / results['default_msgs_per_sec']
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
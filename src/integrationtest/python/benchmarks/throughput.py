@@ -0,0 +1,255 @@
+"""Measure Django transport throughput, latency and CPU cost per message.
+
+``--producers`` processes publish ``-n`` messages in total, spread over
+``--queues`` queues, while ``--consumers`` processes consume from all of them
+on a file-backed SQLite database. The run fails unless the selected
+``--notifier`` wakes up idle consumers. Results are printed as JSON and, with
+``--output``, appended as one JSON line per run to track them over time::
+
+    python -m benchmarks.throughput -n 5000 --producers 2 --consumers 2 \\
+        --size 512 --queues 4 --notifier socket --output results.jsonl
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import socket
+import tempfile
+import time
+from multiprocessing import Event, Queue as ResultQueue, Value
+from queue import Empty
+
+from .common import BenchmarkCase, check, join, migrate, start, wait_ready
+
+EXCHANGE = 'bench'
+
+NOTIFIERS = {
+    'off': 'karellen.kombu.transport.django.notifiers:EventNotifier',
+    'socket': 'karellen.kombu.transport.django.notifiers:SocketNotifier',
+}
+
+
+def connect(options):
+    settings = {
+        'KOMBU_NOTIFIER': NOTIFIERS[options['notifier']],
+        'KOMBU_SQLITE_PRAGMAS': options['pragmas'] or None,
+    }
+    return BenchmarkCase(options['db_path'], settings, {
+        'polling_interval': options['polling_interval'],
+        'fetch_batch_size': options['fetch_batch_size'],
+        'publish_batch_size': options['publish_batch_size'],
+    }).connect()
+
+
+def check_notifier(conn, options):
+    """Fail unless commits wake up the consumers with the notifier of
+    `options`, so the results aren't measuring polling instead."""
+    from kombu.utils import symbol_by_name
+    from karellen.kombu.transport.django import TRANSPORT_NOTIFIERS, database_name
+    from karellen.kombu.transport.django.signals import pre_publish
+
+    notifier = TRANSPORT_NOTIFIERS[conn.transport]
+    expected = symbol_by_name(NOTIFIERS[options['notifier']])
+    if type(notifier) is not expected:
+        raise RuntimeError('{0} is used instead of {1}'.format(
+            type(notifier).__name__, expected.__name__))
+    if not pre_publish.receivers:
+        raise RuntimeError('Publishing does not wake up consumers')
+    if options['notifier'] != 'off':
+        notifier.broadcast(database_name())
+        if not notifier.wait(5):
+            raise RuntimeError('{0} is not woken up by other processes'.format(
+                expected.__name__))
+        notifier.clear()
+
+
+def queues(options):
+    from kombu import Exchange, Queue
+    exchange = Exchange(EXCHANGE, 'direct')
+    return [Queue('bench-%d' % i, exchange, 'bench-%d' % i) for i in range(options['queues'])]
+
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system
+
+
+def produce(options, count, ready, started, results):
+    filler = 'x' * options['size']
+    with connect(options) as conn:
+        check_notifier(conn, options)
+        targets = queues(options)
+        producer = conn.Producer(serializer='json')
+        for queue in targets:
+            queue(producer.channel).declare()
+        ready.set()
+        started.wait()
+        cpu_start = cpu_time()
+        for i in range(count):
+            queue = targets[i % len(targets)]
+            producer.publish({'sent': time.time(), 'filler': filler},
+                             exchange=queue.exchange, routing_key=queue.routing_key)
+        producer.channel.close()
+        results.put(('producer', cpu_time() - cpu_start, [], None))
+
+
+def consume(options, total, ready, started, delivered, results):
+    latencies = []
+    last_delivery = [None]
+
+    def on_message(body, message):
+        last_delivery[0] = time.time()
+        latencies.append(last_delivery[0] - body['sent'])
+        message.ack()
+        with delivered.get_lock():
+            delivered.value += 1
+
+    with connect(options) as conn:
+        check_notifier(conn, options)
+        with conn.Consumer(queues(options), callbacks=[on_message], accept=['json']):
+            ready.set()
+            started.wait()
+            cpu_start = cpu_time()
+            while delivered.value < total:
+                try:
+                    conn.drain_events(timeout=0.5)
+                except socket.timeout:
+                    pass
+            results.put(('consumer', cpu_time() - cpu_start, latencies, last_delivery[0]))
+
+
+def collect(results, count, processes):
+    """Get `count` results, failing if any of `processes` does meanwhile."""
+    collected = []
+    while len(collected) < count:
+        try:
+            collected.append(results.get(timeout=1))
+        except Empty:
+            check(*processes)
+    return collected
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(options):
+    """Run one benchmark with `options` and return its results as a dict."""
+    with tempfile.TemporaryDirectory() as tmp:
+        options = dict(options, db_path=os.path.join(tmp, 'bench.sqlite3'))
+        join(start(migrate, options['db_path']))
+
+        total = options['messages']
+        started = Event()
+        delivered = Value('i', 0)
+        results = ResultQueue()
+
+        consumers = []
+        for _ in range(options['consumers']):
+            ready = Event()
+            process = start(consume, options, total, ready, started, delivered, results)
+            wait_ready(process, ready)
+            consumers.append(process)
+
+        producers = []
+        for i in range(options['producers']):
+            count = total // options['producers'] + (i < total % options['producers'])
+            ready = Event()
+            process = start(produce, options, count, ready, started, results)
+            wait_ready(process, ready)
+            producers.append(process)
+
+        time_start = time.time()
+        started.set()
+        cpu = {'producer': 0.0, 'consumer': 0.0}
+        latencies = []
+        time_end = time_start
+        processes = producers + consumers
+        for role, cpu_seconds, process_latencies, last_delivery in collect(
+                results, len(processes), processes):
+            cpu[role] += cpu_seconds
+            latencies.extend(process_latencies)
+            if last_delivery:
+                time_end = max(time_end, last_delivery)
+        join(*processes, timeout=60)
+
+    latencies.sort()
+    elapsed = time_end - time_start
+    return {
+        'msgs_per_sec': total / elapsed,
+        'elapsed': elapsed,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else None,
+        'cpu_per_msg_us': (cpu['producer'] + cpu['consumer']) / total * 1e6,
+        'producer_cpu_per_msg_us': cpu['producer'] / total * 1e6,
+        'consumer_cpu_per_msg_us': cpu['consumer'] / total * 1e6,
+    }
+
+
+def environment():
+    import django
+    import kombu
+    import sqlite3
+    from karellen.kombu.transport.django import __version__
+    return {
+        'transport_version': __version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'kombu': kombu.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--messages', type=int, default=2000,
+                        help='total number of messages')
+    parser.add_argument('--producers', type=int, default=1, help='producer processes')
+    parser.add_argument('--consumers', type=int, default=1, help='consumer processes')
+    parser.add_argument('--size', type=int, default=100, help='payload size in bytes')
+    parser.add_argument('--queues', type=int, default=1, help='number of queues')
+    parser.add_argument('--polling-interval', type=float, default=1.0,
+                        help='max seconds between polls of idle consumers')
+    parser.add_argument('--notifier', choices=sorted(NOTIFIERS), default='off',
+                        help='cross-process wakeup of idle consumers')
+    parser.add_argument('--fetch-batch-size', type=int, default=10)
+    parser.add_argument('--publish-batch-size', type=int, default=1)
+    parser.add_argument('--pragmas', action='store_true',
+                        help='apply the default KOMBU_SQLITE_PRAGMAS profile')
+    parser.add_argument('--output', help='append the results as a JSON line to this file')
+    args = parser.parse_args()
+
+    options = {
+        'messages': args.messages,
+        'producers': args.producers,
+        'consumers': args.consumers,
+        'size': args.size,
+        'queues': args.queues,
+        'polling_interval': args.polling_interval,
+        'notifier': args.notifier,
+        'fetch_batch_size': args.fetch_batch_size,
+        'publish_batch_size': args.publish_batch_size,
+        'pragmas': args.pragmas,
+    }
+    report = {
+        'benchmark': 'throughput',
+        'timestamp': time.time(),
+        'options': options,
+        'results': run(options),
+        'environment': environment(),
+    }
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
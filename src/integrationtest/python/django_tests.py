@@ -1,14 +1,21 @@
 from __future__ import absolute_import, unicode_literals
 
+import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from kombu import Queue
 
 from funtests import transport
+from funtests.buffering import BufferingChannelCase
 from karellen.kombu import register_transports
 
 register_transports()
 
 
-class test_django(transport.TransportCase):
+class test_django(BufferingChannelCase, transport.TransportCase):
     transport = 'django'
     prefix = 'django'
     event_loop_max = 10
@@ -37,3 +44,939 @@ class test_django(transport.TransportCase):
             call_command('migrate')
         else:
             call_command('syncdb')
+
+    def stored_size(self, chan, queue_name):
+        from karellen.kombu.transport.django.models import Message
+        return Message.objects.filter(queue__name=queue_name, visible=True).count()
+
+    def test_queue_id_cache(self):
+        if not self.verify_alive():
+            return
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from karellen.kombu.transport.django.models import Queue as QueueModel
+
+        name = self.P('queue_id_cache')
+        QueueModel.objects.publish(name, '{}')
+        with CaptureQueriesContext(connection) as ctx:
+            QueueModel.objects.publish(name, '{}')
+        queries = [q['sql'] for q in ctx.captured_queries if q['sql'] != 'BEGIN']
+        self.assertEqual(len(queries), 1)
+
+        # In the caller's transaction the publish gets a savepoint to retry in
+        with transaction.atomic(), CaptureQueriesContext(connection) as ctx:
+            QueueModel.objects.publish(name, '{}')
+        self.assertTrue(ctx.captured_queries[0]['sql'].startswith('SAVEPOINT'))
+
+        # A queue deleted behind the cache's back is recreated on publish
+        QueueModel.objects.filter(name=name).delete()
+        QueueModel.objects.publish(name, '{}')
+        self.assertEqual(QueueModel.objects.size(name), 1)
+        self.assertEqual(QueueModel.objects.purge(name), 1)
+
+    def test_pop_delete_returning(self):
+        if not self.verify_alive():
+            return
+        from karellen.kombu.transport.django.managers import supports_delete_returning
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        conn = Message.objects.connection_for_write()
+        if not supports_delete_returning(conn):
+            self.skipTest('database does not support DELETE ... RETURNING')
+
+        name = self.P('delete_returning')
+        for i in range(5):
+            QueueModel.objects.publish(name, str(i))
+        queue_id = QueueModel.objects.queue_id(name)
+        self.assertEqual(Message.objects.pop_many(queue_id, 3), ['0', '1', '2'])
+        self.assertEqual(Message.objects.filter(queue_id=queue_id).count(), 2)
+
+        Message.objects.delete_returning = False
+        try:
+            self.assertEqual(Message.objects.pop_many(queue_id, 3), ['3', '4'])
+            self.assertEqual(
+                Message.objects.filter(queue_id=queue_id, visible=False).count(), 2)
+        finally:
+            del Message.objects.delete_returning
+        QueueModel.objects.purge(name)
+
+    def test_pop_query_uses_index(self):
+        if not self.verify_alive():
+            return
+        from django.db import connection, transaction
+        from karellen.kombu.transport.django.models import Message
+
+        def explain(kind, params, queue_count=1):
+            sql = Message.objects._sql(connection, kind, queue_count)
+            with transaction.atomic(), connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    # Don't let the planner scan the small test table instead
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                    cursor.execute('EXPLAIN ' + sql, params)
+                else:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return ' '.join(row[-1] for row in cursor.fetchall())
+
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest('query plans are checked on SQLite and PostgreSQL only')
+
+        for kind in ('claim_select', 'claim_delete_returning'):
+            plan = explain(kind, Message.objects._claim_params(connection, (1,), 10))
+            # Claimed and delayed rows are skipped by the index, not filtered,
+            # and the index order is the claim order
+            if connection.vendor == 'sqlite':
+                self.assertIn('djkombu_message_pop_idx (queue_id=? AND visible=?)', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+            else:
+                self.assertIn('djkombu_message_pop_idx', plan)
+                self.assertNotIn('Sort', plan)
+        plan = explain('claim_select', Message.objects._claim_params(connection, None, 10), 0)
+        self.assertIn('djkombu_message_priority_idx', plan)
+        self.assertNotIn('TEMP B-TREE' if connection.vendor == 'sqlite' else 'Sort', plan)
+        self.assertIn('djkombu_message_pop_idx', explain('purge', (1, True, 10)))
+        self.assertIn('djkombu_message_available_idx', explain('purge_delayed', (1, 10)))
+
+    def test_polling_backoff(self):
+        if not self.verify_alive():
+            return
+        import socket
+        transport = self.connection.transport
+        chan = self.connection.channel()
+        consumer = chan.Consumer(self.queue, callbacks=[lambda body, message: message.ack()])
+        self.purge_consumer(consumer)
+        consumer.consume()
+
+        self.assertRaises(socket.timeout, self.connection.drain_events, timeout=0.3)
+        self.assertGreater(transport._polling_delay, transport.polling_interval_min)
+
+        chan.Producer(self.exchange).publish({'foo': 'bar'}, routing_key=self.prefix)
+        self.connection.drain_events(timeout=1)
+        self.assertEqual(transport._polling_delay, transport.polling_interval_min)
+        consumer.cancel()
+        chan.close()
+
+    def test_socket_notifier(self):
+        if not self.verify_alive():
+            return
+        import socket
+        import tempfile
+        from karellen.kombu.transport.django.notifiers import SocketNotifier
+
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skipTest('Unix domain sockets are not available')
+
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as db:
+            n1 = SocketNotifier(db.name)
+            n2 = SocketNotifier(db.name)
+            try:
+                self.assertFalse(n1.wait(0))
+                SocketNotifier.broadcast(db.name)
+                self.assertTrue(n1.wait(1))
+                self.assertTrue(n2.wait(1))
+                n1.clear()
+                self.assertFalse(n1.wait(0))
+                n1.set()
+                self.assertTrue(n1.wait(1))
+                self.assertTrue(n2.wait(0))
+            finally:
+                n1.close()
+                n2.close()
+            # Removed with the last socket
+            self.assertFalse(os.path.exists(n1.dir))
+            SocketNotifier.broadcast(db.name)
+            self.assertFalse(os.path.exists(n1.dir))
+
+            # Wakeups for queues nobody consumes from are ignored
+            n1 = SocketNotifier(db.name, {'a': None})
+            n2 = SocketNotifier(db.name, {'b': None})
+            try:
+                SocketNotifier.broadcast(db.name, {'a'})
+                self.assertTrue(n1.wait(1))
+                self.assertFalse(n2.wait(0.1))
+                SocketNotifier.broadcast(db.name)
+                self.assertTrue(n2.wait(1))
+            finally:
+                n1.close()
+                n2.close()
+            self.assertFalse(os.path.exists(n1.dir))
+
+        # Closing the connection closes its notifier
+        from karellen.kombu.transport.django import TRANSPORT_NOTIFIERS
+        conn = self.get_connection()
+        conn.transport.notifier = 'karellen.kombu.transport.django.notifiers:SocketNotifier'
+        conn.connect()
+        notifier = TRANSPORT_NOTIFIERS[conn.transport]
+        self.assertTrue(os.path.exists(notifier.path))
+        conn.close()
+        self.assertFalse(os.path.exists(notifier.path))
+
+    def test_queue_wakeup(self):
+        if not self.verify_alive():
+            return
+        from django.db import transaction
+        from karellen.kombu.transport.django import (
+            CONNECTION_DATA_PENDING, TRANSPORT_NOTIFIERS, _sqlite_notification, notify_transports)
+        from karellen.kombu.transport.django.signals import pre_publish
+
+        # Connected on every backend, not only with karellen.sqlite3
+        self.assertTrue(pre_publish.receivers)
+        conn2 = self.get_connection()
+        chan1, chan2 = self.connection.channel(), conn2.channel()
+        queue1 = Queue(self.P('wakeup1'), self.exchange, 'wakeup1')(chan1)
+        queue2 = Queue(self.P('wakeup2'), self.exchange, 'wakeup2')(chan2)
+        chan1.Consumer(queue1).consume()
+        chan2.Consumer(queue2).consume()
+        self.purge([queue1.name, queue2.name])
+        notifier1 = TRANSPORT_NOTIFIERS[self.connection.transport]
+        notifier2 = TRANSPORT_NOTIFIERS[conn2.transport]
+        # Stands in for the karellen.sqlite3 connection the hooks are set on
+        db_conn = type('Connection', (), {})()
+        try:
+            notifier1.clear()
+            notifier2.clear()
+            notify_transports({queue1.name})
+            self.assertTrue(notifier1.wait(0))
+            self.assertFalse(notifier2.wait(0))
+            notifier1.clear()
+
+            producer = chan1.Producer(self.exchange)
+            with transaction.atomic():
+                producer.publish({'i': 0}, routing_key='wakeup2')
+                # Not before the commit has returned
+                self.assertFalse(notifier2.wait(0))
+            self.assertFalse(notifier1.wait(0))
+            self.assertTrue(notifier2.wait(0))
+            notifier2.clear()
+
+            # Inserted outside of the managers, as seen by the SQLite hooks
+            CONNECTION_DATA_PENDING[db_conn] = True
+            _sqlite_notification.commit_hook(db_conn)
+            self.assertTrue(notifier1.wait(0))
+            self.assertTrue(notifier2.wait(0))
+        finally:
+            chan1.close()
+            conn2.close()
+
+    def _consume_many(self, consume_order):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        chan1 = self.connection.channel()
+        producer = chan1.Producer(self.exchange)
+        queues = [Queue(self.P('many%d' % i), self.exchange, 'many%d' % i)(chan1)
+                  for i in range(5)]
+        [q.declare() for q in queues]
+        self.purge([q.name for q in queues])
+        for i in (0, 1, 0, 2, 0):
+            producer.publish(i, routing_key='many%d' % i)
+
+        chan2 = self.connection.channel()
+        chan2.consume_order = consume_order
+        consumer = chan2.Consumer(queues)
+        received = [int(m) for m in transport.consumeN(self.connection, consumer, 5)]
+
+        consumer.consume()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertRaises(transport.socket.timeout,
+                              self.connection.drain_events, timeout=0)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        consumer.cancel()
+        chan1.close()
+        chan2.close()
+        return received
+
+    def test_consume_many_round_robin(self):
+        if not self.verify_alive():
+            return
+        self.assertEqual(self._consume_many('round_robin'), [0, 1, 2, 0, 0])
+
+    def test_consume_many_fifo(self):
+        if not self.verify_alive():
+            return
+        self.assertEqual(self._consume_many('fifo'), [0, 1, 0, 2, 0])
+
+    def test_consume_many_uneven_backlog(self):
+        if not self.verify_alive():
+            return
+        chan1 = self.connection.channel()
+        producer = chan1.Producer(self.exchange)
+        queues = [Queue(self.P('uneven%s' % name), self.exchange, 'uneven%s' % name)(chan1)
+                  for name in 'ab']
+        [q.declare() for q in queues]
+        self.purge([q.name for q in queues])
+        for i in range(30):
+            producer.publish('a%d' % i, routing_key='unevena')
+        for i in range(3):
+            producer.publish('b%d' % i, routing_key='unevenb')
+
+        # A backlog in one queue doesn't hold back the others
+        chan2 = self.connection.channel()
+        chan2.fetch_batch_size = 10
+        consumer = chan2.Consumer(queues)
+        received = list(transport.consumeN(self.connection, consumer, 33))
+        self.assertEqual(sorted(received[0:6]), ['a0', 'a1', 'a2', 'b0', 'b1', 'b2'])
+        self.assertEqual(received[6:], ['a%d' % i for i in range(3, 30)])
+
+        # Also when fewer messages are claimed than queues are consumed
+        for i in range(3):
+            producer.publish('a%d' % i, routing_key='unevena')
+            producer.publish('b%d' % i, routing_key='unevenb')
+        chan2.fetch_batch_size = 1
+        received = list(transport.consumeN(self.connection, consumer, 6))
+        self.assertEqual(sorted(received[0:2]), ['a0', 'b0'])
+        consumer.cancel()
+        chan1.close()
+        chan2.close()
+
+    def test_reaper(self):
+        if not self.verify_alive():
+            return
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+        from karellen.kombu.transport.django.reaper import MessageReaper
+
+        name = self.P('reaper')
+        Message.objects.cleanup()
+        for i in range(5):
+            QueueModel.objects.publish(name, str(i))
+        queue_id = QueueModel.objects.queue_id(name)
+        Message.objects.delete_returning = False
+        try:
+            self.assertEqual(len(Message.objects.pop_many(queue_id, 5)), 5)
+        finally:
+            del Message.objects.delete_returning
+
+        reaper = MessageReaper(interval=3600, batch_size=2)
+        self.assertEqual(reaper.reap(), 5)
+        self.assertEqual(reaper.progress['deleted'], 5)
+        self.assertEqual(reaper.progress['runs'], 1)
+        self.assertFalse(Message.objects.filter(visible=False).exists())
+        self.assertEqual(list(Message.objects.iter_cleanup(2)), [])
+
+        # Failed rounds are logged and retried
+        class FailingReaper(MessageReaper):
+            def reap(self):
+                if self.runs:
+                    self.stop()
+                self.runs += 1
+                raise RuntimeError('database is unavailable')
+
+        reaper = FailingReaper(interval=0.01)
+        with self.assertLogs('karellen.kombu.transport.django.reaper', 'ERROR') as logs:
+            reaper.start()
+            reaper.join(5)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_clean_kombu_messages(self):
+        if not self.verify_alive():
+            return
+        from io import StringIO
+        from django.core.management import call_command
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        Message.objects.cleanup()
+        names = [self.P('clean1'), self.P('clean2')]
+        Message.objects.delete_returning = False
+        try:
+            for name in names:
+                for i in range(3):
+                    QueueModel.objects.publish(name, str(i))
+                Message.objects.pop_many(QueueModel.objects.queue_id(name), 3)
+                QueueModel.objects.publish(name, 'expired', ttl=0)
+        finally:
+            del Message.objects.delete_returning
+
+        out = StringIO()
+        call_command('clean_kombu_messages', batch_size=2, queues=[names[0]], stdout=out)
+        self.assertIn('Removed 3 invisible messages', out.getvalue())
+        self.assertIn('Removed 1 expired message\n', out.getvalue())
+        self.assertEqual(Message.objects.filter(visible=False).count(), 3)
+        self.assertEqual(Message.objects.filter(payload='expired').count(), 1)
+
+        out = StringIO()
+        call_command('clean_kombu_messages', older_than=0, vacuum='full', stdout=out)
+        self.assertIn('Removed 3 invisible messages', out.getvalue())
+        self.assertIn('Removed 1 expired message\n', out.getvalue())
+        self.assertIn('Vacuumed', out.getvalue())
+
+        # The runtime limit covers all sweeps
+        QueueModel.objects.publish(names[0], 'expired', ttl=0)
+        out = StringIO()
+        call_command('clean_kombu_messages', max_runtime=0, stdout=out)
+        self.assertNotIn('expired', out.getvalue())
+        self.assertEqual(Message.objects.filter(payload='expired').count(), 1)
+        call_command('clean_kombu_messages', stdout=StringIO())
+
+    def test_sqlite_pragmas(self):
+        if not self.verify_alive():
+            return
+        from django.db import connection
+        from karellen.kombu.transport import django as django_transport
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('pragmas only apply to SQLite')
+
+        django_transport.SQLITE_PRAGMAS = {'cache_size': -1234}
+        try:
+            django_transport.apply_sqlite_pragmas(sender=None, connection=connection)
+        finally:
+            django_transport.SQLITE_PRAGMAS = None
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -1234)
+
+    def test_database_alias(self):
+        if not self.verify_alive():
+            return
+        from types import SimpleNamespace
+        from karellen.kombu.transport import django as django_transport
+        from karellen.kombu.transport.django import managers
+        from karellen.kombu.transport.django.models import Message, Queue
+        from karellen.kombu.transport.django.routers import KombuRouter
+
+        router = KombuRouter('kombu')
+        other = SimpleNamespace(_meta=SimpleNamespace(app_label='other'))
+        self.assertEqual(router.db_for_read(Message), 'kombu')
+        self.assertEqual(router.db_for_write(Queue), 'kombu')
+        self.assertIsNone(router.db_for_write(other))
+        self.assertTrue(router.allow_migrate('kombu', 'karellen_kombu_transport_django'))
+        self.assertFalse(router.allow_migrate('default', 'karellen_kombu_transport_django'))
+        self.assertIsNone(router.allow_migrate('kombu', 'contenttypes'))
+
+        managers.DATABASE_ALIAS = 'kombu'
+        try:
+            self.assertEqual(django_transport.database_alias(), 'kombu')
+            self.assertEqual(Message.objects.filter(visible=True).db, 'kombu')
+            self.assertEqual(Queue.objects.messages_for(1).db, 'kombu')
+            # An explicit using() still wins
+            self.assertEqual(Message.objects.using('default').db, 'default')
+        finally:
+            managers.DATABASE_ALIAS = None
+        self.assertEqual(Message.objects.all().db, 'default')
+
+    def test_raw_sql(self):
+        if not self.verify_alive():
+            return
+        from django.test.utils import CaptureQueriesContext
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        conn = Message.objects.connection_for_write()
+        if not Message.objects.uses_raw_sql(conn):
+            self.skipTest('no prebuilt SQL for %s' % conn.vendor)
+
+        name = self.P('raw_sql')
+        QueueModel.objects.publish(name, '0')
+        queue_id = QueueModel.objects.queue_id(name)
+        with CaptureQueriesContext(conn) as ctx:
+            QueueModel.objects.publish_many({name: [str(i) for i in range(1, 6)]})
+        inserts = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn((conn.alias, 'insert', 5), Message.objects._statements)
+
+        for raw_sql in (True, False):
+            Message.objects.raw_sql = raw_sql
+            Message.objects.delete_returning = False
+            try:
+                self.assertEqual(Message.objects.pop_many(queue_id, 2),
+                                 ['%d' % i for i in (range(2) if raw_sql else range(2, 4))])
+            finally:
+                del Message.objects.raw_sql
+                del Message.objects.delete_returning
+        self.assertEqual(Message.objects.filter(queue_id=queue_id, visible=False).count(), 4)
+        # Consumed messages awaiting cleanup are not counted
+        self.assertEqual(QueueModel.objects.size(name), 2)
+        QueueModel.objects.purge(name)
+
+    def test_metrics(self):
+        if not self.verify_alive():
+            return
+        import socket
+        from karellen.kombu.transport.django import metrics
+
+        sink = metrics.configure('karellen.kombu.transport.django.metrics:PrometheusSink')
+        try:
+            chan = self.connection.channel()
+            queue = Queue(self.P('metrics'), self.exchange, 'metrics')
+            queue = queue(chan)
+            queue.declare()
+            producer = chan.Producer(self.exchange)
+            for i in range(3):
+                producer.publish({'i': i}, routing_key='metrics')
+            self.assertEqual(queue.queue_declare(passive=True).message_count, 3)
+            while queue.get(no_ack=True):
+                pass
+            chan.close()
+        finally:
+            metrics.configure(None)
+
+        text = sink.render()
+        self.assertIn('kombu_published_total{queue="%s"} 3' % queue.name, text)
+        self.assertIn('kombu_queue_depth{queue="%s"} 3' % queue.name, text)
+        self.assertIn('kombu_fetched_total 3', text)
+        self.assertIn('kombu_empty_polls_total 1', text)
+        self.assertIn('# TYPE kombu_claim_seconds histogram', text)
+        self.assertIn('kombu_claim_seconds_count 2', text)
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        statsd = metrics.StatsdSink('127.0.0.1', server.getsockname()[1], tags=True)
+        try:
+            statsd.incr('published', queue='q')
+            statsd.observe('fetch_seconds', 0.25)
+            self.assertEqual(server.recv(512), b'kombu.published:1|c|#queue:q')
+            self.assertEqual(server.recv(512), b'kombu.fetch_seconds:250.0|ms')
+        finally:
+            statsd.close()
+            server.close()
+
+    def test_size(self):
+        if not self.verify_alive():
+            return
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        name = self.P('size')
+        QueueModel.objects.publish_many({name: ['0', '1', '2']})
+        queue_id = QueueModel.objects.queue_id(name)
+        Message.objects.delete_returning = False
+        try:
+            Message.objects.pop(queue_id)
+        finally:
+            del Message.objects.delete_returning
+        self.assertEqual(QueueModel.objects.size(name), 2)
+
+        qs = Message.objects.filter(queue_id=queue_id, visible=True, available_at__isnull=True)
+        if qs.db == 'default' and Message.objects.connection_for_write().vendor == 'sqlite':
+            self.assertIn('djkombu_message_pop_idx', qs.explain())
+
+        QueueModel.objects.size_cache_ttl = 60
+        try:
+            self.assertEqual(QueueModel.objects.size(name), 2)
+            QueueModel.objects.publish(name, '3')
+            self.assertEqual(QueueModel.objects.size(name), 2)
+            # Purging drops the cached size
+            QueueModel.objects.purge(name)
+            self.assertEqual(QueueModel.objects.size(name), 0)
+        finally:
+            del QueueModel.objects.size_cache_ttl
+            QueueModel.objects._sizes.clear()
+
+    def test_chunked_purge(self):
+        if not self.verify_alive():
+            return
+        from django.test.utils import CaptureQueriesContext
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        name = self.P('chunked_purge')
+        other = self.P('chunked_purge_other')
+        conn = Message.objects.connection_for_write()
+        for i, raw_sql in enumerate((True, False)):
+            QueueModel.objects.publish_many({name: ['x'] * 25, other: ['y']})
+            queue_id = QueueModel.objects.queue_id(name)
+            Message.objects.raw_sql = raw_sql
+            try:
+                with CaptureQueriesContext(conn) as ctx:
+                    self.assertEqual(Message.objects.purge(queue_id, batch_size=10), 25)
+            finally:
+                del Message.objects.raw_sql
+            deletes = [q for q in ctx.captured_queries if q['sql'].startswith('DELETE')]
+            # Two more to find no consumed and no delayed messages
+            self.assertEqual(len(deletes), 5 if raw_sql else 3)
+            self.assertEqual(QueueModel.objects.size(other), i + 1)
+        self.assertEqual(QueueModel.objects.purge(name), 0)
+        self.assertEqual(QueueModel.objects.purge(other), 2)
+
+        # Consumed messages awaiting cleanup are deleted, but not counted
+        for raw_sql in (True, False):
+            QueueModel.objects.publish_many({name: ['0', '1', '2', ('3', 0, None, 60)]})
+            queue_id = QueueModel.objects.queue_id(name)
+            Message.objects.raw_sql = raw_sql
+            Message.objects.delete_returning = False
+            try:
+                self.assertEqual(len(Message.objects.pop_many(queue_id, 2)), 2)
+                self.assertEqual(Message.objects.purge(queue_id), 2)
+            finally:
+                del Message.objects.raw_sql
+                del Message.objects.delete_returning
+            self.assertFalse(Message.objects.filter(queue_id=queue_id).exists())
+
+    def test_fanout(self):
+        if not self.verify_alive():
+            return
+        from kombu import Exchange
+        from karellen.kombu.transport.django.models import Broadcast, Message
+
+        exchange = Exchange(self.P('fanout'), 'fanout')
+        chan = self.connection.channel()
+        queues = [Queue(self.P('fanout%d' % i), exchange)(chan) for i in range(3)]
+        for queue in queues:
+            queue.declare()
+        self.purge([queue.name for queue in queues])
+        Message.objects.cleanup()
+        list(Broadcast.objects.iter_cleanup())
+
+        producer = chan.Producer(exchange)
+        producer.publish({'i': 0})
+        producer.publish({'i': 1})
+        self.assertEqual(Broadcast.objects.filter(exchange=exchange.name).count(), 2)
+        pointers = Message.objects.filter(broadcast__exchange=exchange.name)
+        self.assertEqual(pointers.count(), 6)
+        self.assertEqual(set(pointers.values_list('payload', flat=True)), {''})
+
+        # A consumer in another connection receives the broadcasts too
+        conn2 = self.get_connection(**self.connection_options)
+        consumer = conn2.channel().Consumer(queues[0])
+        received = [m['i'] for m in transport.consumeN(conn2, consumer, 2)]
+        self.assertEqual(received, [0, 1])
+        conn2.close()
+        for queue in queues[1:]:
+            self.assertEqual([queue.get(no_ack=True).payload['i'] for _ in range(2)], [0, 1])
+            self.assertIsNone(queue.get(no_ack=True))
+
+        # Broadcasts are deleted once all their messages are consumed
+        Message.objects.cleanup()
+        self.assertEqual(sum(Broadcast.objects.iter_cleanup()), 2)
+
+        queues[0].unbind_from(exchange)
+        producer.publish({'i': 2})
+        self.assertIsNone(queues[0].get(no_ack=True))
+        self.assertEqual(queues[1].get(no_ack=True).payload['i'], 2)
+        chan.close()
+
+    def test_declarations(self):
+        if not self.verify_alive():
+            return
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from kombu import Exchange
+        from karellen.kombu.transport.django.models import Binding, Exchange as ExchangeModel
+
+        exchange = Exchange(self.P('declarations'), 'topic')
+        chan = self.connection.channel()
+        queue = Queue(self.P('declarations'), exchange, 'declarations.#')(chan)
+        queue.declare()
+        self.purge([queue.name])
+        queue.declare()
+        self.assertEqual(ExchangeModel.objects.get(name=exchange.name).type, 'topic')
+        self.assertTrue(Binding.objects.filter(exchange=exchange.name, queue__name=queue.name,
+                                               routing_key='declarations.#').exists())
+
+        # Redeclarations are answered from the cache, only the message count is queried
+        with CaptureQueriesContext(connection) as ctx:
+            exchange(chan).declare()
+            chan.exchange_declare(exchange.name, 'topic', durable=True)
+            chan._new_queue(queue.name)
+            chan._queue_bind(exchange.name, 'declarations.#', None, queue.name)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        with CaptureQueriesContext(connection) as ctx:
+            queue.declare()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        # A new process knows the declarations without redeclaring them
+        self.connection.transport.state.clear()
+        ExchangeModel.objects.forget()
+        Binding.objects.forget()
+        chan2 = self.connection.channel()
+        self.assertEqual(chan2.typeof(exchange.name).type, 'topic')
+        chan2.basic_publish(chan2.prepare_message('hello'), exchange.name, 'declarations.x')
+        self.assertEqual(queue.get(no_ack=True).body, b'hello')
+
+        queue.unbind_from(exchange, 'declarations.#')
+        self.assertFalse(Binding.objects.filter(exchange=exchange.name).exists())
+        chan2.exchange_delete(exchange.name)
+        self.assertFalse(ExchangeModel.objects.filter(name=exchange.name).exists())
+        self.assertNotIn(exchange.name, ExchangeModel.objects.declarations())
+        chan.close()
+        chan2.close()
+
+    def test_priority(self):
+        if not self.verify_alive():
+            return
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        chan = self.connection.channel()
+        producer = chan.Producer(self.exchange)
+        queue = Queue(self.P('priority'), self.exchange, 'priority')(chan)
+        queue.declare()
+        self.purge([queue.name])
+        for i, priority in enumerate((0, 5, 9, 5, None)):
+            producer.publish({'i': i}, routing_key='priority', priority=priority)
+        self.assertEqual([queue.get(no_ack=True).payload['i'] for _ in range(5)],
+                         [2, 1, 3, 0, 4])
+
+        # Across queues and without DELETE ... RETURNING
+        names = [self.P('priority1'), self.P('priority2')]
+        QueueModel.objects.publish_many({names[0]: ['0', ('1', 3, None)],
+                                         names[1]: [('2', 1, None)]})
+        Message.objects.delete_returning = False
+        try:
+            self.assertEqual(QueueModel.objects.fetch_any(names, 10),
+                             [(names[0], '1'), (names[1], '2'), (names[0], '0')])
+        finally:
+            del Message.objects.delete_returning
+        chan.close()
+
+    def test_ttl(self):
+        if not self.verify_alive():
+            return
+        from datetime import timedelta
+        from django.utils import timezone
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        chan = self.connection.channel()
+        producer = chan.Producer(self.exchange)
+        queue = Queue(self.P('ttl'), self.exchange, 'ttl',
+                      queue_arguments={'x-message-ttl': 60000})(chan)
+        queue.declare()
+        self.purge([queue.name])
+        self.assertEqual(QueueModel.objects.get(name=queue.name).message_ttl, 60000)
+
+        producer.publish({'i': 0}, routing_key='ttl')
+        producer.publish({'i': 1}, routing_key='ttl', expiration=10)
+        producer.publish({'i': 2}, routing_key='ttl')
+        messages = Message.objects.filter(queue__name=queue.name).order_by('id')
+        expires_at = list(messages.values_list('expires_at', flat=True))
+        now = timezone.now()
+        self.assertTrue(now + timedelta(seconds=50) < expires_at[0] <= now + timedelta(seconds=60))
+        self.assertTrue(expires_at[1] <= now + timedelta(seconds=10))
+
+        # Expired messages are skipped and swept
+        messages.filter(id=messages[0].id).update(expires_at=now - timedelta(seconds=1))
+        self.assertEqual(QueueModel.objects.size(queue.name), 2)
+        self.assertEqual(queue.get(no_ack=True).payload['i'], 1)
+        self.assertEqual(sum(Message.objects.iter_expire()), 1)
+        self.assertEqual(queue.get(no_ack=True).payload['i'], 2)
+        self.assertIsNone(queue.get(no_ack=True))
+
+        # Queues unused for longer than x-expires are deleted
+        name = self.P('ttl_expires')
+        reply = Queue(name, self.exchange, 'ttl_expires',
+                      queue_arguments={'x-expires': 60000})(chan)
+        reply.declare()
+        self.assertIsNotNone(QueueModel.objects.get(name=name).expires_at)
+        self.assertEqual(QueueModel.objects.expire(), 0)
+        QueueModel.objects.filter(name=name).update(expires_at=now - timedelta(seconds=1))
+        self.assertEqual(QueueModel.objects.expire(), 1)
+        self.assertFalse(QueueModel.objects.filter(name=name).exists())
+        self.assertIsNone(QueueModel.objects.queue_id(name))
+
+        # Other processes notice the expired queue when touching it
+        reply.declare()
+        queue_id = QueueModel.objects.queue_id(name)
+        QueueModel.objects.filter(name=name)._raw_delete(QueueModel.objects.db)
+        QueueModel.objects._touch_due.pop(name, None)
+        self.assertEqual(QueueModel.objects.fetch_many(name, 1), [])
+        self.assertNotIn(name, QueueModel.objects._queue_ids)
+        reply.declare()
+        self.assertNotEqual(QueueModel.objects.queue_id(name), queue_id)
+        chan.close()
+
+    def test_delayed_delivery(self):
+        if not self.verify_alive():
+            return
+        from datetime import datetime, timedelta, timezone as tz
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.utils import timezone
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        chan = self.connection.channel()
+        producer = chan.Producer(self.exchange)
+        queue = Queue(self.P('delayed'), self.exchange, 'delayed')(chan)
+        queue.declare()
+        self.purge([queue.name])
+        now = timezone.now()
+        producer.publish({'i': 0}, routing_key='delayed', headers={'x-delay': 60000})
+        producer.publish({'i': 1}, routing_key='delayed',
+                         headers={'eta': (datetime.now(tz.utc) + timedelta(minutes=2)).isoformat()})
+        producer.publish({'i': 2}, routing_key='delayed')
+        # Unparseable ETAs are delivered right away
+        producer.publish({'i': 3}, routing_key='delayed', headers={'eta': '2026-10-18'})
+        producer.publish({'i': 4}, routing_key='delayed', headers={'eta': 'tomorrow'})
+        delayed = Message.objects.filter(queue__name=queue.name, available_at__isnull=False)
+        available_at = list(delayed.order_by('id').values_list('available_at', flat=True))
+        self.assertEqual(len(available_at), 2)
+        self.assertTrue(now + timedelta(seconds=50) < available_at[0] <= now + timedelta(seconds=61))
+        self.assertTrue(now + timedelta(seconds=110) < available_at[1] <= now + timedelta(seconds=121))
+        self.assertEqual(QueueModel.objects.size(queue.name), 3)
+
+        self.assertEqual([queue.get(no_ack=True).payload['i'] for _ in range(3)], [2, 3, 4])
+        self.assertIsNone(queue.get(no_ack=True))
+
+        # Due messages are released and delivered, nothing is written before
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(Message.objects.release(), 0)
+        self.assertEqual([q['sql'].split()[0] for q in ctx.captured_queries], ['SELECT'])
+        delayed.update(available_at=now - timedelta(seconds=1))
+        self.assertEqual(Message.objects.release(), 2)
+        self.assertEqual([queue.get(no_ack=True).payload['i'] for _ in range(2)], [0, 1])
+
+        # Without releasing, delays are ignored instead of holding messages forever
+        Message.objects.release_interval = None
+        try:
+            producer.publish({'i': 5}, routing_key='delayed', headers={'x-delay': 60000})
+        finally:
+            del Message.objects.release_interval
+        self.assertFalse(delayed.exists())
+        self.assertEqual(queue.get(no_ack=True).payload['i'], 5)
+        chan.close()
+
+    def test_claim_skips_other_backlogs(self):
+        if not self.verify_alive():
+            return
+        from django.db import connection
+        from karellen.kombu.transport.django.models import Queue as QueueModel, Message
+
+        backlog, a, b = self.P('backlog'), self.P('backlog_a'), self.P('backlog_b')
+        QueueModel.objects.publish_many({backlog: [(str(i), 9) for i in range(20000)]})
+        QueueModel.objects.publish_many({a: [('a0', 0), ('a1', 5)], b: [('b0', 5), ('b1', 1)]})
+        try:
+            # Several queues are merged by priority, then in publish order
+            self.assertEqual(QueueModel.objects.fetch_any([a, b], 3),
+                             [(a, 'a1'), (b, 'b0'), (b, 'b1')])
+            Message.objects.raw_sql = False
+            try:
+                self.assertEqual(QueueModel.objects.fetch_any([a, b], 3), [(a, 'a0')])
+            finally:
+                del Message.objects.raw_sql
+            self.assertEqual(QueueModel.objects.fetch_any([a, b], 3), [])
+
+            # Round-robin claims take a share from every queue
+            QueueModel.objects.publish_many({a: [('a2', 9), ('a3', 9)], b: [('b2', 0)]})
+            self.assertEqual(QueueModel.objects.fetch_any([a, b], 2, round_robin=True),
+                             [(a, 'a2'), (b, 'b2')])
+            self.assertEqual(QueueModel.objects.fetch_any([b, a], 1, round_robin=True),
+                             [(a, 'a3')])
+
+            if connection.vendor == 'sqlite':
+                # Each queue is read by an index seek, never by walking the
+                # messages of all queues
+                for kind in ('claim_select', 'claim_delete_returning',
+                             'claim_select_round_robin', 'claim_delete_returning_round_robin'):
+                    sql = Message.objects._sql(connection, kind, 2)
+                    params = Message.objects._claim_params(connection, (1, 2), 10)
+                    with connection.cursor() as cursor:
+                        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                        plan = ' '.join(row[-1] for row in cursor.fetchall())
+                    self.assertIn('djkombu_message_pop_idx', plan)
+                    self.assertNotIn('available_idx', plan)
+        finally:
+            self.assertEqual(QueueModel.objects.purge(backlog), 20000)
+
+    def test_consumers_claim_disjoint_messages(self):
+        if not self.verify_alive():
+            return
+        chan1 = self.connection.channel()
+        producer = chan1.Producer(self.exchange)
+        queue = Queue(self.P('disjoint'), self.exchange, 'disjoint')
+        queue(chan1).declare()
+        self.purge([queue.name])
+        for i in range(30):
+            producer.publish({'i': i}, routing_key='disjoint')
+
+        consumers = []
+        for _ in range(3):
+            chan = self.connection.channel()
+            chan.fetch_batch_size = 4
+            consumers.append(queue(chan))
+
+        received = []
+        while len(received) < 30:
+            got = [c.get() for c in consumers]
+            if not any(got):
+                break
+            for m in got:
+                if m:
+                    received.append(m.payload['i'])
+                    m.ack()
+        self.assertEqual(sorted(received), list(range(30)))
+        for c in consumers:
+            c.channel.close()
+        chan1.close()
+
+    @contextmanager
+    def _file_database(self):
+        """Route the transport to a file-backed SQLite database, which unlike
+        an in-memory one is shared by the connections of all threads."""
+        import tempfile
+        from django.core.management import call_command
+        from django.db import connections
+        from karellen.kombu.transport.django import managers
+        from karellen.kombu.transport.django.models import Queue as QueueModel
+
+        with tempfile.TemporaryDirectory() as tmp:
+            connections.databases['file'] = dict(
+                connections.databases['default'], NAME=os.path.join(tmp, 'kombu.sqlite3'))
+            try:
+                call_command('migrate', database='file', verbosity=0)
+                QueueModel.objects.forget()
+                managers.DATABASE_ALIAS = 'file'
+                yield
+            finally:
+                managers.DATABASE_ALIAS = None
+                QueueModel.objects.forget()
+                connections['file'].close()
+                del connections['file']
+                del connections.databases['file']
+
+    def _consume_concurrently(self, queue, consumers):
+        received = []
+
+        def consume():
+            from django.db import connections
+            conn = self.get_connection()
+            try:
+                chan = conn.channel()
+                q = queue(chan)
+                while 1:
+                    m = q.get(no_ack=True)
+                    if not m:
+                        break
+                    received.append(m.payload['i'])
+            finally:
+                conn.close()
+                connections.close_all()
+
+        threads = [threading.Thread(target=consume) for _ in range(consumers)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.time() - start, received
+
+    def test_concurrent_consumers_scale(self):
+        if not self.verify_alive():
+            return
+        from django.db import connections
+        from karellen.kombu.transport.django import database_alias
+
+        if connections[database_alias()].vendor == 'sqlite':
+            with self._file_database():
+                self._check_concurrent_consumers()
+        else:
+            self._check_concurrent_consumers()
+
+    def _check_concurrent_consumers(self):
+        from django.db import connections
+        from karellen.kombu.transport.django import database_alias
+        from karellen.kombu.transport.django.managers import supports_skip_locked
+
+        n = 2000
+        chan = self.connection.channel()
+        producer = chan.Producer(self.exchange)
+        queue = Queue(self.P('concurrent'), self.exchange, 'concurrent')
+        queue(chan).declare()
+        rates = []
+        for consumers in (1, 4):
+            self.purge([queue.name])
+            for i in range(n):
+                producer.publish({'i': i}, routing_key='concurrent')
+            elapsed, received = self._consume_concurrently(queue, consumers)
+            # Every message is claimed by exactly one of the consumers
+            self.assertEqual(sorted(received), list(range(n)))
+            rates.append(n / elapsed)
+        chan.close()
+        # Without SKIP LOCKED, as on SQLite, claims are serialized by the
+        # database and only correctness is checked
+        if supports_skip_locked(connections[database_alias()]):
+            self.assertGreater(rates[1], rates[0] * 1.5)
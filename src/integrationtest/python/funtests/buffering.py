@@ -0,0 +1,76 @@
+from __future__ import absolute_import, unicode_literals
+
+from kombu import Queue
+
+from funtests import transport
+
+
+class BufferingChannelCase(object):
+    """Tests of channels using :class:`karellen.kombu.buffering.BufferingChannelMixin`,
+    mixed into a :class:`~funtests.transport.TransportCase`."""
+
+    def stored_size(self, chan, queue_name):
+        """Return the number of messages of `queue_name` in the database,
+        bypassing the buffers of `chan`."""
+        raise NotImplementedError()
+
+    def test_batched_get(self):
+        if not self.verify_alive():
+            return
+        chan1 = self.connection.channel()
+        producer = chan1.Producer(self.exchange)
+        chan2 = self.connection.channel()
+        chan2.fetch_batch_size = 10
+        queue = Queue(self.P('batched_get'), self.exchange, 'batched_get')
+        queue = queue(chan2)
+        queue.declare()
+        self.purge([queue.name])
+        for i in range(15):
+            producer.publish({'i': i}, routing_key='batched_get')
+
+        m = queue.get()
+        self.assertEqual(m.payload, {'i': 0})
+        m.ack()
+        self.assertEqual(len(chan2._fetched[queue.name]), 9)
+        self.assertEqual(self.stored_size(chan2, queue.name), 5)
+
+        # Closing the channel puts undelivered messages back on the queue
+        chan2.close()
+        chan3 = self.connection.channel()
+        queue = queue(chan3)
+        received = []
+        while 1:
+            m = queue.get()
+            if not m:
+                break
+            received.append(m.payload['i'])
+            m.ack()
+        self.assertItemsEqual(received, list(range(1, 15)))
+        chan1.close()
+        chan3.close()
+
+    def test_buffered_publish(self):
+        if not self.verify_alive():
+            return
+        chan1 = self.connection.channel()
+        chan1.publish_batch_size = 10
+        chan1.publish_flush_interval = 3600
+        producer = chan1.Producer(self.exchange)
+        queue = Queue(self.P('buffered'), self.exchange, 'buffered')
+        queue(chan1).declare()
+        self.purge([queue.name])
+        for i in range(25):
+            producer.publish({'i': i}, routing_key='buffered')
+        self.assertEqual(self.stored_size(chan1, queue.name), 20)
+        # ... or by a timer, after publish_flush_interval
+        self.assertTrue(chan1._put_timer.is_alive())
+
+        # Pending messages are flushed before the channel is closed
+        chan1.close()
+        self.assertIsNone(chan1._put_timer)
+        chan2 = self.connection.channel()
+        self.assertEqual(self.stored_size(chan2, queue.name), 25)
+        consumer = chan2.Consumer(queue)
+        received = [m['i'] for m in transport.consumeN(self.connection, consumer, 25)]
+        self.assertEqual(received, list(range(25)))
+        chan2.close()
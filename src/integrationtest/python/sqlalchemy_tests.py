@@ -0,0 +1,62 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from kombu import Queue
+
+from funtests import transport
+from funtests.buffering import BufferingChannelCase
+from karellen.kombu import register_transports
+
+register_transports()
+
+
+class test_sqlalchemy(BufferingChannelCase, transport.TransportCase):
+    transport = 'sqlalchemy'
+    prefix = 'sqlalchemy'
+    event_loop_max = 10
+    connection_options = {'hostname': 'sqlite://'}
+
+    def before_connect(self):
+        try:
+            import sqlalchemy  # noqa
+        except ImportError:
+            self.skipTest('SQLAlchemy is not installed')
+
+    def stored_size(self, chan, queue_name):
+        return chan.store.size(queue_name)
+
+    def test_buffered_publish_timer(self):
+        if not self.verify_alive():
+            return
+        from sqlalchemy.pool import StaticPool
+
+        # The timer thread must see the in-memory database
+        conn = self.get_connection(hostname='sqlite://', transport_options={'engine_options': {
+            'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}})
+        chan = conn.channel()
+        chan.publish_batch_size = 10
+        chan.publish_flush_interval = 0.1
+        producer = chan.Producer(self.exchange)
+        queue = Queue(self.P('buffered_timer'), self.exchange, 'buffered_timer')
+        queue(chan).declare()
+        for i in range(3):
+            producer.publish({'i': i}, routing_key='buffered_timer')
+
+        # Flushed without any further publish
+        deadline = time.time() + 5
+        while chan.store.size(queue.name) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(chan.store.size(queue.name), 3)
+        self.assertIsNone(chan._put_timer)
+        conn.close()
+
+    def test_shared_store(self):
+        if not self.verify_alive():
+            return
+        chan1 = self.connection.channel()
+        conn2 = self.get_connection(**self.connection_options)
+        chan2 = conn2.channel()
+        self.assertIs(chan1.store, chan2.store)
+        chan1.close()
+        conn2.close()
@@ -0,0 +1,113 @@
+"""Channel mixin batching database round trips of the virtual transports.
+
+Claimed messages are buffered per queue and delivered from the buffer, so a
+round trip claims up to :attr:`~BufferingChannelMixin.fetch_batch_size`
+messages. Published messages can be buffered too and written together,
+see :attr:`~BufferingChannelMixin.publish_batch_size`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+
+from kombu.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class BufferingChannelMixin(object):
+    """Buffers claimed and published messages of a virtual channel.
+
+    Channels call :meth:`_buffer_put` from ``_put`` and implement
+    :meth:`_put_many`, which writes a ``{queue: [item, ...]}`` mapping of
+    buffered or restored messages.
+    """
+
+    #: Max number of messages claimed from the database per round trip.
+    #: Claimed messages are buffered in the channel until delivered.
+    fetch_batch_size = 10
+
+    #: Number of published messages buffered in the channel before they
+    #: are written together. ``1`` disables buffering.
+    publish_batch_size = 1
+
+    #: Max age in seconds of the oldest buffered message before the buffer
+    #: is flushed by a timer thread.
+    publish_flush_interval = 1.0
+
+    buffering_transport_options = (
+        'fetch_batch_size', 'publish_batch_size', 'publish_flush_interval')
+
+    def __init__(self, *args, **kwargs):
+        super(BufferingChannelMixin, self).__init__(*args, **kwargs)
+        self._fetched = {}
+        self._fetched_rotation = 0
+        self._put_buffer = {}
+        self._put_buffer_size = 0
+        self._put_lock = threading.RLock()
+        self._put_timer = None
+
+    def _buffer_put(self, queue, item):
+        with self._put_lock:
+            self._put_buffer.setdefault(queue, []).append(item)
+            self._put_buffer_size += 1
+            if self._put_buffer_size >= self.publish_batch_size:
+                self._flush_put_buffer()
+            elif self._put_timer is None:
+                self._put_timer = threading.Timer(self.publish_flush_interval,
+                                                  self._flush_put_buffer_on_timer)
+                self._put_timer.daemon = True
+                self._put_timer.start()
+
+    def _put_many(self, queue_items):
+        raise NotImplementedError('Channels must implement _put_many')
+
+    def _flush_put_buffer(self):
+        with self._put_lock:
+            if self._put_timer is not None:
+                self._put_timer.cancel()
+                self._put_timer = None
+            if self._put_buffer_size:
+                self._put_many(self._put_buffer)
+                self._put_buffer = {}
+                self._put_buffer_size = 0
+
+    def _flush_put_buffer_on_timer(self):
+        try:
+            self._flush_put_buffer()
+        except Exception:
+            # Kept in the buffer until the next publish or close
+            logger.exception('Failed to flush buffered messages')
+
+    def _fetch_limit(self):
+        limit = self.fetch_batch_size
+        estimate = self.qos.can_consume_max_estimate()
+        if estimate:
+            limit = min(limit, estimate)
+        return max(limit, 1)
+
+    def _next_fetched(self, queues):
+        # Rotate between the consumed queues with buffered messages
+        count = len(queues)
+        for i in range(count):
+            queue = queues[(self._fetched_rotation + i) % count]
+            if self._fetched.get(queue):
+                self._fetched_rotation = (self._fetched_rotation + i + 1) % count
+                return queue
+
+    def _restore_fetched(self):
+        # Messages claimed but never delivered are put back on their queues
+        fetched, self._fetched = self._fetched, {}
+        fetched = {queue: [self._restored(payload) for payload in payloads]
+                   for queue, payloads in fetched.items() if payloads}
+        if fetched:
+            self._put_many(fetched)
+
+    def _restored(self, payload):
+        # Item of _put_many() republishing a claimed `payload`
+        return payload
+
+    def close(self):
+        if not self.closed:
+            self._flush_put_buffer()
+            self._restore_fetched()
+        super(BufferingChannelMixin, self).close()
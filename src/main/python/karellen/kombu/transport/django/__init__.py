@@ -3,17 +3,25 @@ from __future__ import absolute_import, unicode_literals
 
 import socket
 import weakref
-from threading import Event
-from time import sleep
+from collections import deque
 
 from django.conf import settings
 from django.core import exceptions as errors
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from kombu.five import Empty, monotonic
 from kombu.transport import virtual
 from kombu.utils import cached_property, symbol_by_name
 from kombu.utils.encoding import bytes_to_str
 from kombu.utils.json import loads, dumps
 
+from karellen.kombu.buffering import BufferingChannelMixin
+
+from . import metrics
+from .reaper import ensure_reaper
+from .signals import pre_publish
+
 try:
     from django.apps import AppConfig
 except ImportError:  # pragma: no cover
@@ -38,51 +46,327 @@ except errors.ImproperlyConfigured:
     POLLING_INTERVAL = 5.0
     settings.configure()
 
+FETCH_BATCH_SIZE = getattr(settings, 'KOMBU_FETCH_BATCH_SIZE', 10)
+CONSUME_ORDER = getattr(settings, 'KOMBU_CONSUME_ORDER', 'round_robin')
+PUBLISH_BATCH_SIZE = getattr(settings, 'KOMBU_PUBLISH_BATCH_SIZE', 1)
+PUBLISH_FLUSH_INTERVAL = getattr(settings, 'KOMBU_PUBLISH_FLUSH_INTERVAL', 1.0)
+POLLING_INTERVAL_MIN = getattr(settings, 'KOMBU_POLLING_INTERVAL_MIN', 0.01)
+POLLING_BACKOFF = getattr(settings, 'KOMBU_POLLING_BACKOFF', 2.0)
+CLEANUP_INTERVAL = getattr(settings, 'KOMBU_CLEANUP_INTERVAL', 60.0)
+CLEANUP_PAUSE = getattr(settings, 'KOMBU_CLEANUP_PAUSE', 0.1)
+NOTIFIER = getattr(settings, 'KOMBU_NOTIFIER',
+                   'karellen.kombu.transport.django.notifiers:EventNotifier')
+SQLITE_PRAGMAS = getattr(settings, 'KOMBU_SQLITE_PRAGMAS', None)
+METRICS = getattr(settings, 'KOMBU_METRICS', None)
+
+#: SQLite profile applied with ``KOMBU_SQLITE_PRAGMAS = True``: WAL lets
+#: producers and consumers in different processes work concurrently and
+#: fsyncs on checkpoints instead of on every commit.
+DEFAULT_SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16384),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+)
+
 TRANSPORT_NOTIFIERS = weakref.WeakKeyDictionary()
 
+metrics.configure(METRICS)
+
 
-class Channel(virtual.Channel):
+class Channel(BufferingChannelMixin, virtual.Channel):
     queue_model = 'karellen.kombu.transport.django.models:Queue'
+    exchange_model = 'karellen.kombu.transport.django.models:Exchange'
+    binding_model = 'karellen.kombu.transport.django.models:Binding'
+
+    #: Fanout messages are stored once and delivered to all bound queues,
+    #: see :meth:`~karellen.kombu.transport.django.managers.QueueManager.publish_fanout`.
+    supports_fanout = True
+
+    #: Buffering defaults, see :class:`~karellen.kombu.buffering.BufferingChannelMixin`.
+    fetch_batch_size = FETCH_BATCH_SIZE
+    publish_batch_size = PUBLISH_BATCH_SIZE
+    publish_flush_interval = PUBLISH_FLUSH_INTERVAL
+
+    #: Messages of all consumed queues are claimed together with one query.
+    #: This is the order they are claimed and delivered in:
+    #: ``'round_robin'`` claims a share from every queue and rotates between
+    #: the queues, ``'fifo'`` follows the order of publishing.
+    consume_order = CONSUME_ORDER
+
+    from_transport_options = (
+        virtual.Channel.from_transport_options +
+        BufferingChannelMixin.buffering_transport_options +
+        ('consume_order',)
+    )
 
-    def _new_queue(self, queue, **kwargs):
-        self.Queue.objects.get_or_create(name=queue)
+    def __init__(self, *args, **kwargs):
+        super(Channel, self).__init__(*args, **kwargs)
+        self._fetched_order = deque()
+        self._claim_rotation = 0
+        self._restore_declarations()
+
+    def _restore_declarations(self):
+        # Exchanges and bindings declared by any process are stored in the
+        # database and loaded once per process, add them to the broker state
+        state = self.state
+        for exchange, (type, durable, auto_delete) in \
+                self.Exchange.objects.declarations().items():
+            if exchange not in state.exchanges:
+                state.exchanges[exchange] = {
+                    'type': type,
+                    'durable': durable,
+                    'auto_delete': auto_delete,
+                    'arguments': {},
+                    'table': [],
+                }
+        for exchange, queue, routing_key in self.Binding.objects.declarations():
+            if exchange in state.exchanges and not state.has_binding(queue, exchange, routing_key):
+                state.binding_declare(queue, exchange, routing_key, None)
+                state.exchanges[exchange]['table'].append(
+                    self.typeof(exchange).prepare_bind(queue, exchange, routing_key, None))
+
+    def exchange_declare(self, exchange=None, type='direct', durable=False,
+                         auto_delete=False, arguments=None, nowait=False, passive=False):
+        super(Channel, self).exchange_declare(exchange, type, durable, auto_delete,
+                                              arguments, nowait, passive)
+        if not passive:
+            type = type or 'direct'
+            self.Exchange.objects.declare(exchange or 'amq.%s' % type, type,
+                                          durable, auto_delete)
+
+    def exchange_delete(self, exchange, if_unused=False, nowait=False):
+        super(Channel, self).exchange_delete(exchange, if_unused, nowait)
+        self.Exchange.objects.remove(exchange)
+        self.Binding.objects.remove(exchange)
+
+    def _new_queue(self, queue, arguments=None, **kwargs):
+        message_ttl = expires = None
+        if arguments:
+            message_ttl = arguments.get('x-message-ttl')
+            expires = arguments.get('x-expires')
+        self.Queue.objects.declare(queue, message_ttl, expires)
+        if message_ttl is not None or expires is not None:
+            # Expired messages and queues are deleted by the reaper
+            self.connection.ensure_reaper()
+
+    def _get_message_ttl(self, message):
+        # Per-message TTL in seconds from the `expiration` property
+        try:
+            return float(message['properties']['expiration']) / 1000.0
+        except (TypeError, ValueError, KeyError):
+            return None
+
+    def _get_message_delay(self, message):
+        # Seconds to hold the message back in the database: the `x-delay`
+        # header in milliseconds or the ETA of a Celery task. Redelivered
+        # messages were held back already.
+        headers = message.get('headers')
+        if not headers or message.get('redelivered'):
+            return None
+        try:
+            delay = headers.get('x-delay')
+            if delay is not None:
+                return float(delay) / 1000.0
+            eta = headers.get('eta')
+            if eta:
+                eta = parse_datetime(eta)
+                if eta is None:
+                    # Not a datetime, deliver right away
+                    return None
+                now = timezone.now()
+                if timezone.is_aware(now) and timezone.is_naive(eta):
+                    eta = timezone.make_aware(eta)
+                elif timezone.is_naive(now) and timezone.is_aware(eta):
+                    # Without USE_TZ now is the system's local time
+                    eta = eta.astimezone().replace(tzinfo=None)
+                return (eta - now).total_seconds()
+        except (TypeError, ValueError):
+            pass
+        return None
 
     def _put(self, queue, message, **kwargs):
-        self.Queue.objects.publish(queue, dumps(message))
+        sink = metrics.sink
+        if sink is not None:
+            sink.incr('published', queue=queue)
+        priority = self._get_message_priority(message)
+        ttl = self._get_message_ttl(message)
+        if ttl is not None:
+            self.connection.ensure_reaper()
+        delay = self._get_message_delay(message)
+        if self.publish_batch_size <= 1 or self.closed:
+            self.Queue.objects.publish(queue, dumps(message), priority, ttl, delay)
+            return
+
+        self._buffer_put(queue, (dumps(message), priority, ttl, delay))
 
-    def basic_consume(self, queue, *args, **kwargs):
-        qinfo = self.state.queue_bindings(queue)
-        exchange = next(qinfo)
+    def _put_many(self, queue_items):
+        self.Queue.objects.publish_many(queue_items)
+
+    def _flush_put_buffer_on_timer(self):
+        try:
+            super(Channel, self)._flush_put_buffer_on_timer()
+        finally:
+            # Don't hold on to the timer thread's connection
+            self.refresh_connection()
+
+    def _queue_bind(self, exchange, routing_key, pattern, queue):
+        self.Binding.objects.declare(exchange, queue, routing_key)
         if self.typeof(exchange).type == 'fanout':
-            return
-        super(Channel, self).basic_consume(queue, *args, **kwargs)
+            # Broadcasts are deleted by the reaper once consumed
+            self.connection.ensure_reaper()
+
+    def queue_unbind(self, queue, exchange=None, routing_key='', arguments=None, **kwargs):
+        if exchange:
+            self.Binding.objects.remove(exchange, queue, routing_key)
+        super(Channel, self).queue_unbind(queue, exchange, routing_key, arguments, **kwargs)
+
+    def _delete(self, queue, exchange, routing_key, *meta, **kwargs):
+        self.Binding.objects.remove(exchange, queue, routing_key)
+        super(Channel, self)._delete(queue, exchange, routing_key, *meta, **kwargs)
+
+    def _put_fanout(self, exchange, message, routing_key, **kwargs):
+        # Keep the order with buffered messages published before
+        self._flush_put_buffer()
+        count = self.Queue.objects.publish_fanout(exchange, dumps(message),
+                                                  self._get_message_priority(message),
+                                                  self._get_message_ttl(message),
+                                                  self._get_message_delay(message))
+        sink = metrics.sink
+        if sink is not None and count:
+            sink.incr('broadcast', exchange=exchange)
 
     def _get(self, queue):
-        m = self.Queue.objects.fetch(queue)
-        if m:
-            return loads(bytes_to_str(m))
+        fetched = self._fetched.get(queue)
+        if not fetched:
+            self._flush_put_buffer()
+            fetched = self._fetched[queue] = deque(
+                self._fetch(self.Queue.objects.fetch_many, queue, self._fetch_limit()))
+        if fetched:
+            return loads(bytes_to_str(fetched.popleft()))
         raise Empty()
 
+    def _get_many(self, queues, timeout=None):
+        queue = self._next_fetched(queues)
+        if queue is None:
+            self._flush_put_buffer()
+            fifo = self.consume_order == 'fifo'
+            names = list(queues)
+            if not fifo:
+                # Another queue goes first on every claim, see claim()
+                start = self._claim_rotation % len(names)
+                self._claim_rotation = start + 1
+                names = names[start:] + names[:start]
+            claimed = self._fetch(self.Queue.objects.fetch_any, names, self._fetch_limit(),
+                                  not fifo)
+            if not claimed:
+                raise Empty()
+            for queue, payload in claimed:
+                self._fetched.setdefault(queue, deque()).append(payload)
+                if fifo:
+                    self._fetched_order.append(queue)
+            queue = self._next_fetched(queues)
+        message = loads(bytes_to_str(self._fetched[queue].popleft()))
+        self.connection._deliver(message, queue)
+
+    def _fetch(self, fetch, *args):
+        # Claim messages from the database with `fetch`
+        sink = metrics.sink
+        if sink is None:
+            return fetch(*args)
+        time_start = monotonic()
+        claimed = fetch(*args)
+        sink.observe('fetch_seconds', monotonic() - time_start)
+        sink.incr('polls')
+        if claimed:
+            sink.incr('fetched', len(claimed))
+        else:
+            sink.incr('empty_polls')
+        return claimed
+
+    def _next_fetched(self, queues):
+        # Pick the consumed queue to deliver the next buffered message from
+        if self.consume_order == 'fifo':
+            order = self._fetched_order
+            while order:
+                queue = order.popleft()
+                if queue in queues and self._fetched.get(queue):
+                    return queue
+        return super(Channel, self)._next_fetched(queues)
+
     def _size(self, queue):
-        return self.Queue.objects.size(queue)
+        self._flush_put_buffer()
+        size = self.Queue.objects.size(queue)
+        sink = metrics.sink
+        if sink is not None:
+            sink.gauge('queue_depth', size, queue=queue)
+        return size
 
     def _purge(self, queue):
-        return self.Queue.objects.purge(queue)
+        self._flush_put_buffer()
+        fetched = self._fetched.pop(queue, None)
+        count = self.Queue.objects.purge(queue)
+        if fetched:
+            count = (count or 0) + len(fetched)
+        sink = metrics.sink
+        if sink is not None and count:
+            sink.incr('purged', count, queue=queue)
+        return count
+
+    def _restore_fetched(self):
+        self._fetched_order.clear()
+        super(Channel, self)._restore_fetched()
+
+    def _restored(self, payload):
+        # Republished with its priority, the TTL starts over
+        message = loads(bytes_to_str(payload))
+        return payload, self._get_message_priority(message), self._get_message_ttl(message)
 
     def refresh_connection(self):
-        from django import db
-        db.close_connection()
+        from django.db import connections
+        connections[database_alias()].close()
 
     @cached_property
     def Queue(self):
         return symbol_by_name(self.queue_model)
 
+    @cached_property
+    def Exchange(self):
+        return symbol_by_name(self.exchange_model)
+
+    @cached_property
+    def Binding(self):
+        return symbol_by_name(self.binding_model)
+
 
 class Transport(virtual.Transport):
     Channel = Channel
 
     default_port = 0
+
+    #: Max time to wait between unsuccessful polls.
     polling_interval = POLLING_INTERVAL
+
+    #: Time to wait after the first unsuccessful poll. Each further empty
+    #: poll multiplies the wait by :attr:`polling_backoff`, up to
+    #: :attr:`polling_interval`. A delivery or a notifier wakeup resets it.
+    polling_interval_min = POLLING_INTERVAL_MIN
+    polling_backoff = POLLING_BACKOFF
+
+    #: Seconds between runs of the background thread deleting consumed
+    #: messages, see :mod:`~karellen.kombu.transport.django.reaper`.
+    #: It is only started where claiming doesn't delete messages right away,
+    #: once a queue is bound to a fanout exchange or once a TTL is used.
+    #: ``None`` disables it.
+    cleanup_interval = CLEANUP_INTERVAL
+
+    #: Seconds to pause between the deleted chunks.
+    cleanup_pause = CLEANUP_PAUSE
+
+    #: Wakeup notifier class, see :mod:`~karellen.kombu.transport.django.notifiers`.
+    notifier = NOTIFIER
     channel_errors = (
         virtual.Transport.channel_errors + (
             errors.ObjectDoesNotExist, errors.MultipleObjectsReturned)
@@ -92,94 +376,224 @@ class Transport(virtual.Transport):
 
     def __init__(self, client, **kwargs):
         super().__init__(client, **kwargs)
-        TRANSPORT_NOTIFIERS[self] = Event()
+        for opt_name in ('polling_interval_min', 'polling_backoff',
+                         'cleanup_interval', 'cleanup_pause'):
+            value = client.transport_options.get(opt_name)
+            if value is not None:
+                setattr(self, opt_name, value)
+        self._reset_polling_delay()
         self.shutdown = False
+        from karellen.kombu.transport.django.models import Message
+        if Message.objects.needs_cleanup():
+            self.ensure_reaper()
+
+    def ensure_reaper(self):
+        """Start the reaper unless it is disabled or already running."""
+        if self.cleanup_interval:
+            ensure_reaper(self.cleanup_interval, pause=self.cleanup_pause)
+
+    @cached_property
+    def Notifier(self):
+        return symbol_by_name(self.notifier)
+
+    def _reset_polling_delay(self):
+        if self.polling_interval is None:
+            self._polling_delay = None
+        else:
+            self._polling_delay = min(self.polling_interval_min, self.polling_interval)
 
     def driver_version(self):
         import django
         return '.'.join(map(str, django.VERSION))
 
+    def establish_connection(self):
+        if self not in TRANSPORT_NOTIFIERS:
+            TRANSPORT_NOTIFIERS[self] = self.Notifier(database_name(), self._callbacks)
+        return super().establish_connection()
+
     def drain_events(self, connection, timeout=None):
+        for channel in self.channels:
+            channel._flush_put_buffer()
         time_start = monotonic()
         get = self.cycle.get
-        polling_interval = self.polling_interval
-        if timeout and polling_interval and polling_interval > timeout:
-            polling_interval = timeout
-        consume_pending = False  # We know there is a message to consume because we've been
+        notifier = TRANSPORT_NOTIFIERS[self]
         while 1:
             try:
                 get(self._deliver, timeout=timeout)
-                consume_pending = False
             except Empty:
-                if self.shutdown or (timeout is not None and monotonic() - time_start >= timeout):
+                elapsed = monotonic() - time_start
+                # The connection may have been closed meanwhile
+                closed = TRANSPORT_NOTIFIERS.get(self) is not notifier
+                if self.shutdown or closed or (timeout is not None and elapsed >= timeout):
                     raise socket.timeout()
-                if consume_pending:
-                    sleep(0.000001)
-                elif polling_interval is not None:
-                    notifier = TRANSPORT_NOTIFIERS[self]
-                    was_notified = notifier.wait(polling_interval)
-                    if not was_notified and timeout is not None and monotonic() - time_start >= timeout:
-                        raise socket.timeout()
+                delay = self._polling_delay
+                if delay is None:
+                    continue
+                if timeout is not None:
+                    delay = min(delay, timeout - elapsed)
+                sink = metrics.sink
+                if notifier.wait(delay):
                     notifier.clear()
-                    consume_pending = True
-                    sleep(0.000001)
+                    self._reset_polling_delay()
+                    if sink is not None:
+                        sink.incr('notifier_wakeups')
+                else:
+                    if sink is not None:
+                        sink.incr('poll_timeouts')
+                    self._polling_delay = min(self._polling_delay * self.polling_backoff,
+                                              self.polling_interval)
             else:
+                self._reset_polling_delay()
                 break
 
     def close_connection(self, connection):
         super().close_connection(connection)
-        notifier = TRANSPORT_NOTIFIERS[self]
-        notifier.set()
+        notifier = TRANSPORT_NOTIFIERS.pop(self, None)
+        if notifier is not None:
+            # Wakes up drain_events before the notifier's socket is removed
+            notifier.set()
+            notifier.close()
+
+
+def database_alias():
+    """Alias of the database the transport models are stored in.
+
+    ``KOMBU_DATABASE_ALIAS`` if set, otherwise the one the routers pick.
+    """
+    from karellen.kombu.transport.django.managers import db_alias
+    from karellen.kombu.transport.django.models import Message
+    return db_alias(Message)
+
+
+def database_name(connection=None):
+    """Name of the database the transport models are stored in."""
+    if connection is None:
+        from django.db import connections
+        connection = connections[database_alias()]
+    return connection.settings_dict['NAME']
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """Apply ``KOMBU_SQLITE_PRAGMAS`` to new SQLite connections serving
+    the transport models.
+
+    The setting is either ``True`` for :data:`DEFAULT_SQLITE_PRAGMAS` or a
+    mapping (or sequence of pairs) of pragma names to values.
+    """
+    pragmas = SQLITE_PRAGMAS
+    if not pragmas or connection.vendor != 'sqlite':
+        return
+
+    if connection.alias != database_alias():
+        return
+
+    if pragmas is True:
+        pragmas = DEFAULT_SQLITE_PRAGMAS
+    elif hasattr(pragmas, 'items'):
+        pragmas = pragmas.items()
+    with connection.cursor() as cursor:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+
+
+connection_created.connect(apply_sqlite_pragmas)
 
 
 try:
     from karellen.sqlite3 import UpdateHookOps
-    from django.db.backends.signals import connection_created
 except:
     UpdateHookOps = None
-
-if UpdateHookOps:
+else:
     UPDATE_OPS = {UpdateHookOps.SQLITE_INSERT}  # , UpdateHookOps.SQLITE_UPDATE}
 
-    CONNECTION_DATA_PENDING = weakref.WeakKeyDictionary()
+CONNECTION_DATA_PENDING = weakref.WeakKeyDictionary()
+CONNECTION_PUBLISHED = weakref.WeakKeyDictionary()
 
 
-    def notify_all_transports(shutdown=False):
-        for transport, notifier in list(TRANSPORT_NOTIFIERS.items()):
-            transport.shutdown = shutdown
+def notify_all_transports(shutdown=False):
+    for transport, notifier in list(TRANSPORT_NOTIFIERS.items()):
+        transport.shutdown = shutdown
+        notifier.set()
+
+
+def notify_transports(queues):
+    """Wake up only the transports consuming from any of `queues`."""
+    for transport, notifier in list(TRANSPORT_NOTIFIERS.items()):
+        if not queues.isdisjoint(transport._callbacks):
             notifier.set()
 
 
-    class SqliteMessageExistsNotification:
-        def __init__(self):
-            self.message_table_name = None
+class SqliteMessageExistsNotification:
+    """Wakes up transports when messages are committed.
 
-        def rollback_hook(self, conn):
-            CONNECTION_DATA_PENDING[conn] = False
+    Messages published through the managers name their queues, and the
+    transports consuming from them are woken up (in other processes too,
+    see :attr:`notifier`) once the commit has returned, so the database
+    isn't kept locked meanwhile. This works on every backend. Other inserts
+    are detected by the SQLite update hook of karellen.sqlite3, if
+    installed, and wake up all transports of this process.
+    """
 
-        def commit_hook(self, conn):
-            data_pending = CONNECTION_DATA_PENDING.get(conn)
-            if data_pending:
-                CONNECTION_DATA_PENDING[conn] = False
+    def __init__(self):
+        self.message_table_name = None
+
+    @cached_property
+    def notifier(self):
+        return symbol_by_name(NOTIFIER)
+
+    def rollback_hook(self, conn):
+        CONNECTION_DATA_PENDING[conn] = False
+        CONNECTION_PUBLISHED.pop(conn, None)
+
+    def commit_hook(self, conn):
+        published = CONNECTION_PUBLISHED.pop(conn, False)
+        if CONNECTION_DATA_PENDING.get(conn):
+            CONNECTION_DATA_PENDING[conn] = False
+            if not published:
+                # Inserted outside of the managers, queues are unknown
                 notify_all_transports()
 
-        def update_hook(self, conn, op, db_name, table_name, rowid):
-            if op in UPDATE_OPS and table_name == self.message_table_name:
-                CONNECTION_DATA_PENDING[conn] = True
+    def record_pending_queues(self, sender, queues, using, **kwargs):
+        from django.db import connections, transaction
+        connection = connections[using]
+        conn = connection.connection
+        if hasattr(conn, 'set_update_hook') and conn in CONNECTION_DATA_PENDING:
+            CONNECTION_PUBLISHED[conn] = True
+        database, queues = database_name(connection), frozenset(queues)
+        # Publishing runs in a transaction, see QueueManager
+        transaction.on_commit(lambda: self.notify_committed(database, queues), using=using)
+
+    def notify_committed(self, database, queues):
+        notify_transports(queues)
+        try:
+            self.notifier.broadcast(database, queues)
+        except OSError:
+            # Never fail the publish because other processes can't be woken up
+            pass
+
+    def update_hook(self, conn, op, db_name, table_name, rowid):
+        if op in UPDATE_OPS and table_name == self.message_table_name:
+            CONNECTION_DATA_PENDING[conn] = True
+
+    def activate_sqlite_update_hook(self, sender, connection, **kwargs):
+        conn = connection.connection
+        if (connection.vendor == 'sqlite' and hasattr(conn, "set_update_hook") and
+                connection.alias == database_alias()):
+
+            message_table_name = self.message_table_name
+            if not message_table_name:
+                from karellen.kombu.transport.django.models import Message
+                self.message_table_name = Message._meta.db_table
 
-        def activate_sqlite_update_hook(self, sender, connection, **kwargs):
-            conn = connection.connection
-            if connection.vendor == 'sqlite' and hasattr(conn, "set_update_hook"):
+            CONNECTION_DATA_PENDING[conn] = False
+            conn.set_update_hook(self.update_hook)
+            conn.set_commit_hook(self.commit_hook)
+            conn.set_rollback_hook(self.rollback_hook)
 
-                message_table_name = self.message_table_name
-                if not message_table_name:
-                    from karellen.kombu.transport.django.models import Message
-                    self.message_table_name = Message._meta.db_table
 
-                CONNECTION_DATA_PENDING[conn] = False
-                conn.set_update_hook(self.update_hook)
-                conn.set_commit_hook(self.commit_hook)
-                conn.set_rollback_hook(self.rollback_hook)
+_sqlite_notification = SqliteMessageExistsNotification()
 
+pre_publish.connect(_sqlite_notification.record_pending_queues, weak=False)
 
-    connection_created.connect(SqliteMessageExistsNotification().activate_sqlite_update_hook, weak=False)
+if UpdateHookOps:
+    connection_created.connect(_sqlite_notification.activate_sqlite_update_hook, weak=False)
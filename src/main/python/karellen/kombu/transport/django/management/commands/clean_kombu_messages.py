@@ -1,22 +1,129 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.core.management.base import BaseCommand
+from datetime import timedelta
+from time import sleep
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from kombu.five import monotonic
 
 
 def pluralize(desc, value):
-    if value > 1:
+    if value != 1:
         return desc + 's'
     return desc
 
 
 class Command(BaseCommand):
+    help = 'Delete consumed and expired messages from the database in chunks.'
     requires_model_validation = True
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Max number of messages deleted per transaction.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to sleep between transactions.')
+        parser.add_argument(
+            '--max-runtime', type=float, default=None,
+            help='Stop after this many seconds.')
+        parser.add_argument(
+            '--queue', action='append', dest='queues', default=None,
+            help='Only clean this queue. Can be repeated.')
+        parser.add_argument(
+            '--older-than', type=float, default=None,
+            help='Only delete messages sent more than this many seconds ago.')
+        parser.add_argument(
+            '--vacuum', choices=('incremental', 'full'), default=None,
+            help='Reclaim free pages afterwards (SQLite only).')
+
     def handle(self, *args, **options):
-        from karellen.kombu.transport.django.models import Message
+        from karellen.kombu.transport.django.models import Queue, Message, Broadcast
+
+        queue_ids = None
+        if options['queues']:
+            queue_ids = []
+            for name in options['queues']:
+                queue_id = Queue.objects.queue_id(name)
+                if queue_id is None:
+                    self.stderr.write('Queue {0!r} does not exist'.format(name))
+                else:
+                    queue_ids.append(queue_id)
+            if not queue_ids:
+                return
+
+        sent_before = None
+        if options['older_than'] is not None:
+            sent_before = timezone.now() - timedelta(seconds=options['older_than'])
+
+        batch_size = options['batch_size']
+        self.pause = options['sleep']
+        self.deadline = None
+        if options['max_runtime'] is not None:
+            self.deadline = monotonic() + options['max_runtime']
+        self.stdout.write('Removing invisible messages from database...')
+        time_start = monotonic()
+        count = self.sweep(Message.objects.iter_cleanup(batch_size, queue_ids, sent_before))
+        elapsed = monotonic() - time_start
+
+        self.stdout.write('Removed {0} invisible {1} in {2:.2f}s ({3:.0f} messages/s)'.format(
+            count, pluralize('message', count), elapsed, count / elapsed if elapsed else 0))
+
+        count = self.sweep(Message.objects.iter_expire(batch_size, queue_ids, sent_before))
+        if count:
+            self.stdout.write('Removed {0} expired {1}'.format(
+                count, pluralize('message', count)))
+
+        # Expired queues are deleted with all of their messages, regardless
+        # of when they were sent
+        if sent_before is None and not self.stopped():
+            count = Queue.objects.expire(queue_ids)
+            if count:
+                self.stdout.write('Removed {0} expired {1}'.format(
+                    count, pluralize('queue', count)))
+
+        # Broadcasts belong to no queue
+        if queue_ids is None:
+            count = self.sweep(Broadcast.objects.iter_cleanup(batch_size, sent_before))
+            if count:
+                self.stdout.write('Removed {0} consumed {1}'.format(
+                    count, pluralize('broadcast', count)))
+
+        if options['vacuum']:
+            self.vacuum(Message.objects.connection_for_write(), options['vacuum'])
+
+    def stopped(self):
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def sweep(self, chunks):
+        """Consume the per-chunk deletion counts of `chunks` until the
+        maximum runtime is reached, pausing in between. Returns the total."""
+        count = 0
+        if self.stopped():
+            return count
+        for deleted in chunks:
+            count += deleted
+            if self.stopped():
+                self.stdout.write('Maximum runtime reached, stopping')
+                break
+            if self.pause:
+                sleep(self.pause)
+        return count
 
-        count = Message.objects.filter(visible=False).count()
+    def vacuum(self, connection, mode):
+        if connection.vendor != 'sqlite':
+            raise CommandError('--vacuum is only supported on SQLite')
 
-        print('Removing {0} invisible {1} from database... '.format(
-            count, pluralize('message', count)))
-        Message.objects.cleanup()
+        with connection.cursor() as cursor:
+            if mode == 'full':
+                cursor.execute('VACUUM')
+            else:
+                cursor.execute('PRAGMA auto_vacuum')
+                if cursor.fetchone()[0] != 2:
+                    raise CommandError(
+                        'incremental vacuum requires PRAGMA auto_vacuum=INCREMENTAL '
+                        'followed by a full VACUUM')
+                cursor.execute('PRAGMA incremental_vacuum')
+                cursor.fetchall()
+        self.stdout.write('Vacuumed database ({0})'.format(mode))
@@ -1,13 +1,35 @@
 from __future__ import absolute_import, unicode_literals
 
+from datetime import timedelta
+
 from vine.utils import wraps
 
-from django.db import transaction, connection, models
+from django.conf import settings
+from django.db import transaction, connection, models, IntegrityError
+from django.utils import timezone
 try:
     from django.db import connections, router
 except ImportError:  # pre-Django 1.2
     connections = router = None  # noqa
 
+from kombu.five import monotonic
+
+from . import metrics
+from .signals import pre_publish
+
+#: Database all transport queries go to, regardless of the routers.
+DATABASE_ALIAS = getattr(settings, 'KOMBU_DATABASE_ALIAS', None)
+
+
+def db_alias(model):
+    """Alias of the database `model` is stored in: ``KOMBU_DATABASE_ALIAS``
+    if set, otherwise the one the routers pick for writes."""
+    if DATABASE_ALIAS:
+        return DATABASE_ALIAS
+    if router:
+        return router.db_for_write(model)
+    return 'default'
+
 
 try:
     transaction.atomic
@@ -16,80 +38,946 @@ except AttributeError:
 else:
     def commit_on_success(fun):
         @wraps(fun)
-        def _commit(*args, **kwargs):
-            with transaction.atomic():
-                return fun(*args, **kwargs)
+        def _commit(manager, *args, **kwargs):
+            with transaction.atomic(using=db_alias(manager.model)):
+                return fun(manager, *args, **kwargs)
         return _commit
 
 
-class QueueManager(models.Manager):
+class AliasManagerMixin(object):
+    """Sends every query of the manager to ``KOMBU_DATABASE_ALIAS``."""
 
-    def publish(self, queue_name, payload):
-        queue, created = self.get_or_create(name=queue_name)
-        queue.messages.create(payload=payload)
+    def get_queryset(self):
+        queryset = super(AliasManagerMixin, self).get_queryset()
+        if DATABASE_ALIAS and not self._db:
+            queryset = queryset.using(DATABASE_ALIAS)
+        return queryset
 
-    def fetch(self, queue_name):
+
+class QueueManager(AliasManagerMixin, models.Manager):
+    #: Process-local cache of queue name to primary key.
+    _queue_ids = {}
+
+    #: Seconds :meth:`size` answers from a process-local cache before
+    #: counting again. ``0`` disables the cache.
+    size_cache_ttl = getattr(settings, 'KOMBU_SIZE_CACHE_TTL', 0)
+
+    #: Process-local cache of queue name to ``(expiry, size)``.
+    _sizes = {}
+
+    #: Process-local cache of queue name to ``(message_ttl, expires)``.
+    _queue_options = {}
+
+    #: Process-local cache of queue name to the monotonic time at which
+    #: :meth:`touch` pushes back the queue's expiry again.
+    _touch_due = {}
+
+    def queue_id(self, queue_name, create=False):
+        """Return the primary key of the queue named `queue_name`.
+
+        Known names are answered from a process-local cache without touching
+        the database. Unknown names are looked up (and created if `create`
+        is set) and cached along with their TTL options. Returns ``None``
+        for a missing queue.
+        """
         try:
-            queue = self.get(name=queue_name)
-        except self.model.DoesNotExist:
+            return self._queue_ids[queue_name]
+        except KeyError:
+            pass
+
+        if create:
+            queue = self.get_or_create(name=queue_name)[0]
+            queue_id, message_ttl, expires = queue.pk, queue.message_ttl, queue.expires
+        else:
+            row = self.filter(name=queue_name).values_list(
+                'id', 'message_ttl', 'expires').first()
+            if row is None:
+                return
+            queue_id, message_ttl, expires = row
+        self._queue_ids[queue_name] = queue_id
+        self._queue_options[queue_name] = (message_ttl, expires)
+        return queue_id
+
+    def forget(self, queue_name=None):
+        """Drop `queue_name` (or every queue) from the queue id cache."""
+        if queue_name is None:
+            self._queue_ids.clear()
+            self._queue_options.clear()
+            self._touch_due.clear()
+        else:
+            self._queue_ids.pop(queue_name, None)
+            self._queue_options.pop(queue_name, None)
+            self._touch_due.pop(queue_name, None)
+
+    def declare(self, queue_name, message_ttl=None, expires=None):
+        """Create queue `queue_name` unless it exists.
+
+        ``x-message-ttl`` and ``x-expires`` are given in milliseconds as
+        `message_ttl` and `expires`. They are stored unless both are
+        ``None`` or the cache has them stored already, so redeclarations
+        cost no queries.
+        """
+        queue_id = self.queue_id(queue_name, create=True)
+        options = (message_ttl, expires)
+        if options != (None, None) and self._queue_options.get(queue_name) != options:
+            self.filter(id=queue_id).update(message_ttl=message_ttl, expires=expires)
+            self._queue_options[queue_name] = options
+        self.touch((queue_name,))
+
+    def touch(self, queue_names):
+        """Push back the expiry of those of `queue_names` with ``x-expires``.
+
+        The expiry is written at most once per half of the queue's
+        ``x-expires`` period. Queues found expired by then are dropped from
+        the cache, see :meth:`expire`.
+        """
+        now = monotonic()
+        for queue_name in queue_names:
+            expires = self._queue_options.get(queue_name, (None, None))[1]
+            if expires is None or self._touch_due.get(queue_name, 0) > now:
+                continue
+            expires /= 1000.0
+            if not self.filter(id=self._queue_ids.get(queue_name)).update(
+                    expires_at=timezone.now() + timedelta(seconds=expires)):
+                self.forget(queue_name)
+                continue
+            self._touch_due[queue_name] = now + expires / 2
+
+    def expire(self, queue_ids=None):
+        """Delete the queues unused for longer than their ``x-expires``,
+        along with their messages, only those of `queue_ids` if given.
+        Returns the number of deleted queues.
+
+        Only this process forgets the deleted queues right away. Others
+        keep their cached ids until :meth:`touch` finds the queue gone, or a
+        publish to it fails and recreates it.
+        """
+        now = timezone.now()
+        deleted = 0
+        expired = self.filter(expires_at__lte=now)
+        if queue_ids is not None:
+            expired = expired.filter(id__in=queue_ids)
+        for queue_id, queue_name in expired.values_list('id', 'name'):
+            self.message_model.objects.purge(queue_id)
+            # Unless used in the meantime
+            deleted += self.filter(id=queue_id, expires_at__lte=now).delete()[1].get(
+                self.model._meta.label, 0)
+            self.forget(queue_name)
+        return deleted
+
+    def expires_at(self, queue_name, ttl=None, start=None):
+        """Return when a message published to `queue_name` expires, `ttl`
+        seconds or the queue's ``x-message-ttl`` after `start` (default
+        now), whichever is sooner. ``None`` if neither is set."""
+        message_ttl = self._queue_options.get(queue_name, (None, None))[0]
+        return expiry(ttl, message_ttl, start)
+
+    def available_at(self, delay):
+        """Return when a message published now and held back for `delay`
+        seconds becomes available. ``None`` if right away, which is always
+        the case with releasing disabled, see
+        :attr:`MessageManager.release_interval`."""
+        if self.message_model.objects.release_interval is not None:
+            return availability(delay)
+
+    def _row(self, queue_id, queue_name, payload, priority=0, ttl=None, delay=None):
+        # Row of MessageManager.insert()
+        available_at = self.available_at(delay)
+        return (queue_id, payload, priority, self.expires_at(queue_name, ttl, available_at),
+                available_at)
+
+    @property
+    def message_model(self):
+        return self.model.messages.field.model
+
+    @property
+    def binding_model(self):
+        return self.model.bindings.field.model
+
+    def messages_for(self, queue_id):
+        """Return the messages of `queue_id` without loading the queue row."""
+        return self.message_model.objects.filter(queue_id=queue_id)
+
+    def publish(self, queue_name, payload, priority=0, ttl=None, delay=None):
+        """Publish `payload` to `queue_name`, expiring after `ttl` seconds
+        (see :meth:`expires_at`) and held back for `delay` seconds if
+        given."""
+        try:
+            self._publish(queue_name, payload, priority, ttl, delay)
+        except IntegrityError:
+            # The cached queue was deleted from under us, recreate it
+            self.forget(queue_name)
+            self._publish(queue_name, payload, priority, ttl, delay)
+
+    @commit_on_success
+    def _publish(self, queue_name, payload, priority, ttl, delay):
+        # A savepoint within the caller's transaction, which is still usable
+        # for the retry after an IntegrityError
+        queue_id = self.queue_id(queue_name, create=True)
+        pre_publish.send(sender=self.message_model, queues=(queue_name,),
+                         using=db_alias(self.message_model))
+        self.message_model.objects.insert(
+            [self._row(queue_id, queue_name, payload, priority, ttl, delay)])
+
+    def publish_many(self, queue_payloads):
+        """Publish a mapping of queue name to payload list with bulk
+        INSERTs in one transaction.
+
+        Payloads are published with priority ``0``, without TTL and delay
+        unless given as ``(payload, priority, ttl, delay)`` tuples, of which
+        trailing items can be left out.
+        """
+        try:
+            self._publish_many(queue_payloads)
+        except IntegrityError:
+            for queue_name in queue_payloads:
+                # The cached queue was deleted from under us, recreate it
+                self.forget(queue_name)
+            self._publish_many(queue_payloads)
+
+    @commit_on_success
+    def _publish_many(self, queue_payloads):
+        message_model = self.message_model
+        rows = []
+        for queue_name, payloads in queue_payloads.items():
+            queue_id = self.queue_id(queue_name, create=True)
+            for payload in payloads:
+                if isinstance(payload, tuple):
+                    rows.append(self._row(queue_id, queue_name, *payload))
+                else:
+                    rows.append(self._row(queue_id, queue_name, payload))
+        pre_publish.send(sender=message_model, queues=tuple(queue_payloads),
+                         using=db_alias(message_model))
+        message_model.objects.insert(rows)
+
+    @commit_on_success
+    def publish_fanout(self, exchange, payload, priority=0, ttl=None, delay=None):
+        """Deliver `payload` to every queue bound to the fanout `exchange`.
+
+        The payload is written once as a broadcast and every bound queue gets
+        a message pointing to it. Returns the number of queues.
+        """
+        message_model = self.message_model
+        bound = list(self.binding_model.objects.filter(exchange=exchange).values_list(
+            'queue_id', 'queue__name', 'queue__message_ttl').distinct())
+        if not bound:
+            return 0
+
+        pre_publish.send(sender=message_model, queues=tuple(name for _, name, _ in bound),
+                         using=db_alias(message_model))
+        broadcast_model = message_model.broadcast.field.related_model
+        broadcast = broadcast_model.objects.create(exchange=exchange, payload=payload)
+        available_at = self.available_at(delay)
+        message_model.objects.insert(
+            [(queue_id, '', priority, expiry(ttl, message_ttl, available_at), available_at)
+             for queue_id, _, message_ttl in bound],
+            broadcast_id=broadcast.pk)
+        return len(bound)
+
+    def fetch(self, queue_name):
+        queue_id = self.queue_id(queue_name)
+        if queue_id is None:
             return
 
-        return queue.messages.pop()
+        return self.message_model.objects.pop(queue_id)
+
+    def fetch_many(self, queue_name, limit):
+        queue_id = self.queue_id(queue_name)
+        if queue_id is None:
+            return []
+
+        self.touch((queue_name,))
+        return self.message_model.objects.pop_many(queue_id, limit)
+
+    def fetch_any(self, queue_names, limit, round_robin=False):
+        """Claim up to `limit` messages from any of `queue_names` in one query.
+
+        Returns ``(queue_name, payload)`` pairs in delivery order. With
+        `round_robin` each queue gets its share of `limit`, see
+        :meth:`MessageManager.claim`.
+        """
+        names = {}
+        for queue_name in queue_names:
+            queue_id = self.queue_id(queue_name)
+            if queue_id is not None:
+                names[queue_id] = queue_name
+        if not names:
+            return []
+
+        self.touch(names.values())
+        return [(names[queue_id], payload) for queue_id, payload
+                in self.message_model.objects.claim(tuple(names), limit, round_robin)]
 
     def size(self, queue_name):
-        return self.get(name=queue_name).messages.count()
+        """Return the number of messages waiting in `queue_name`.
+
+        Only visible messages are counted, so consumed messages awaiting
+        cleanup, expired and delayed messages are not included. The count
+        walks the queue's entries in the claim index. With
+        :attr:`size_cache_ttl` repeated calls within the TTL return the
+        cached count.
+        """
+        ttl = self.size_cache_ttl
+        if ttl:
+            cached = self._sizes.get(queue_name)
+            if cached is not None and cached[0] > monotonic():
+                return cached[1]
+
+        queue_id = self.queue_id(queue_name)
+        if queue_id is None:
+            raise self.model.DoesNotExist(queue_name)
+
+        size = self.messages_for(queue_id).filter(
+            visible=True, available_at__isnull=True).exclude(
+            expires_at__lte=timezone.now()).count()
+        if ttl:
+            self._sizes[queue_name] = (monotonic() + ttl, size)
+        return size
 
     def purge(self, queue_name):
-        try:
-            queue = self.get(name=queue_name)
-        except self.model.DoesNotExist:
+        queue_id = self.queue_id(queue_name)
+        self.forget(queue_name)
+        self._sizes.pop(queue_name, None)
+        if queue_id is None:
             return
 
-        messages = queue.messages.all()
-        count = messages.count()
-        messages.delete()
-        return count
+        return self.message_model.objects.purge(queue_id)
+
+
+def expiry(ttl, message_ttl=None, start=None):
+    """Return the expiry of a message available at `start` (default now)
+    with a TTL of `ttl` seconds in a queue with an ``x-message-ttl`` of
+    `message_ttl` milliseconds, or ``None`` if neither is set."""
+    if message_ttl is not None:
+        message_ttl /= 1000.0
+        ttl = message_ttl if ttl is None else min(ttl, message_ttl)
+    if ttl is not None:
+        return (start or timezone.now()) + timedelta(seconds=ttl)
+
+
+def queue_share(limit, queue_count):
+    """Return the share of `limit` messages claimed from each of
+    `queue_count` queues by a round-robin claim."""
+    return -(-limit // queue_count)
+
+
+def availability(delay):
+    """Return when a message published now and held back for `delay`
+    seconds becomes available, or ``None`` if it is available right away."""
+    if delay is not None and delay > 0:
+        return timezone.now() + timedelta(seconds=delay)
+
+
+#: Backends the hot path SQL of :class:`MessageManager` is written for.
+RAW_SQL_VENDORS = ('sqlite', 'postgresql', 'mysql')
 
 
-def select_for_update(qs):
-    if connection.vendor == 'oracle':
+def supports_delete_returning(conn):
+    """Whether `conn` can claim rows with ``DELETE ... RETURNING``."""
+    if conn.vendor == 'postgresql':
+        return True
+    if conn.vendor == 'sqlite':
+        return conn.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def supports_skip_locked(conn=None):
+    conn = conn or connection
+    return (conn.vendor != 'oracle' and
+            getattr(conn.features, 'has_select_for_update_skip_locked', False))
+
+
+def select_for_update(qs, skip_locked=False, conn=None):
+    conn = conn or connection
+    if conn.vendor == 'oracle':
         return qs
     try:
+        if skip_locked and supports_skip_locked(conn):
+            return qs.select_for_update(skip_locked=True)
         return qs.select_for_update()
     except AttributeError:
         return qs
 
 
-class MessageManager(models.Manager):
-    _messages_received = [0]
-    cleanup_every = 10
+class ExchangeManager(AliasManagerMixin, models.Manager):
+    #: Process-local cache of exchange name to ``(type, durable, auto_delete)``,
+    #: loaded by :meth:`declarations`.
+    _exchanges = None
+
+    def declarations(self):
+        """Return the declared exchanges, loading all of them from the
+        database into the process-local cache on first use."""
+        exchanges = ExchangeManager._exchanges
+        if exchanges is None:
+            exchanges = ExchangeManager._exchanges = {
+                name: (type, durable, auto_delete) for name, type, durable, auto_delete
+                in self.values_list('name', 'type', 'durable', 'auto_delete')}
+        return exchanges
+
+    def declare(self, name, type, durable=True, auto_delete=False):
+        """Store exchange `name`, unless the cache has it declared the same way."""
+        declaration = (type, durable, auto_delete)
+        exchanges = self.declarations()
+        if exchanges.get(name) != declaration:
+            self.update_or_create(name=name, defaults={
+                'type': type, 'durable': durable, 'auto_delete': auto_delete})
+            exchanges[name] = declaration
+
+    def remove(self, name):
+        """Delete exchange `name`. Its bindings are left to the caller."""
+        self.filter(name=name).delete()
+        self.declarations().pop(name, None)
+
+    def forget(self):
+        """Drop the cache, so the exchanges are loaded again on next use."""
+        ExchangeManager._exchanges = None
+
+
+class BindingManager(AliasManagerMixin, models.Manager):
+    #: Process-local cache of ``(exchange, queue name, routing key)``
+    #: bindings, loaded by :meth:`declarations`.
+    _bindings = None
+
+    def declarations(self):
+        """Return the declared bindings, loading all of them from the
+        database into the process-local cache on first use."""
+        bindings = BindingManager._bindings
+        if bindings is None:
+            bindings = BindingManager._bindings = set(
+                self.values_list('exchange', 'queue__name', 'routing_key'))
+        return bindings
+
+    def declare(self, exchange, queue_name, routing_key=''):
+        """Bind `queue_name` to `exchange` with `routing_key`, unless the
+        cache has the binding already."""
+        binding = (exchange, queue_name, routing_key)
+        bindings = self.declarations()
+        if binding in bindings:
+            return
+
+        try:
+            self._declare(exchange, queue_name, routing_key)
+        except IntegrityError:
+            # The cached queue was deleted from under us, recreate it
+            self.model.queue.field.related_model.objects.forget(queue_name)
+            self._declare(exchange, queue_name, routing_key)
+        bindings.add(binding)
+
+    @commit_on_success
+    def _declare(self, exchange, queue_name, routing_key):
+        queues = self.model.queue.field.related_model.objects
+        self.get_or_create(exchange=exchange, routing_key=routing_key,
+                           queue_id=queues.queue_id(queue_name, create=True))
+
+    def remove(self, exchange, queue_name=None, routing_key=None):
+        """Delete the bindings of `queue_name` (or all queues) to `exchange`,
+        only those with `routing_key` if given."""
+        bindings = self.filter(exchange=exchange)
+        if queue_name is not None:
+            bindings = bindings.filter(queue__name=queue_name)
+        if routing_key is not None:
+            bindings = bindings.filter(routing_key=routing_key)
+        bindings.delete()
+        self.declarations().difference_update([
+            binding for binding in self.declarations()
+            if binding[0] == exchange and queue_name in (None, binding[1]) and
+            routing_key in (None, binding[2])])
+
+    def forget(self, queue_name=None):
+        """Drop the cached bindings of `queue_name`, or the whole cache so
+        the bindings are loaded again on next use."""
+        if queue_name is None:
+            BindingManager._bindings = None
+        elif BindingManager._bindings:
+            BindingManager._bindings.difference_update([
+                binding for binding in BindingManager._bindings if binding[1] == queue_name])
+
+
+class BroadcastManager(AliasManagerMixin, models.Manager):
+    def iter_cleanup(self, batch_size=None, sent_before=None):
+        """Delete broadcasts no message points to any more, in chunks of up
+        to `batch_size`, only those sent before the `sent_before` datetime
+        if given. Yields the number deleted by every chunk."""
+        batch_size = batch_size or self.model.messages.field.model.objects.cleanup_batch_size
+        orphans = self.filter(messages=None)
+        if sent_before is not None:
+            orphans = orphans.filter(sent_at__lt=sent_before)
+        while 1:
+            ids = list(orphans.values_list('id', flat=True)[0:batch_size])
+            if not ids:
+                break
+            yield self.filter(id__in=ids).delete()[0]
+
+
+class MessageManager(AliasManagerMixin, models.Manager):
+    #: Max number of consumed messages deleted per statement by :meth:`cleanup`.
+    cleanup_batch_size = getattr(settings, 'KOMBU_CLEANUP_BATCH_SIZE', 1000)
+
+    #: Max number of messages deleted per statement by :meth:`purge`.
+    purge_batch_size = getattr(settings, 'KOMBU_PURGE_BATCH_SIZE', 5000)
+
+    #: Skip rows locked by other consumers instead of waiting for them,
+    #: where the database supports ``SELECT ... FOR UPDATE SKIP LOCKED``.
+    skip_locked = getattr(settings, 'KOMBU_SKIP_LOCKED', True)
+
+    #: Claim and delete messages with a single ``DELETE ... RETURNING``
+    #: statement on backends that support it (PostgreSQL, SQLite >= 3.35).
+    delete_returning = getattr(settings, 'KOMBU_DELETE_RETURNING', True)
+
+    #: Publish and claim with prebuilt SQL reading and writing only the
+    #: columns needed, instead of querysets and model instances, on the
+    #: backends in :data:`RAW_SQL_VENDORS`.
+    raw_sql = getattr(settings, 'KOMBU_RAW_SQL', True)
+
+    #: Max number of rows written by one INSERT statement.
+    insert_batch_size = 100
+
+    #: Min seconds between two runs of :meth:`release` before a claim.
+    #: ``None`` disables delayed delivery: messages are published
+    #: available right away, whatever their delay.
+    release_interval = getattr(settings, 'KOMBU_RELEASE_INTERVAL', 1.0)
+
+    #: Monotonic time of the next :meth:`release` run in this process.
+    _release_due = 0
+
+    #: Statements built by :meth:`_sql`, by connection alias.
+    _statements = {}
+
+    def pop(self, queue_id=None):
+        payloads = self.pop_many(queue_id, 1)
+        if payloads:
+            return payloads[0]
+
+    def pop_many(self, queue_id, limit):
+        """Claim up to `limit` visible messages of `queue_id`, see :meth:`claim`.
+
+        Payloads are returned in delivery order.
+        """
+        queue_ids = None if queue_id is None else (queue_id,)
+        return [payload for _, payload in self.claim(queue_ids, limit)]
+
+    def insert(self, rows, broadcast_id=None):
+        """Insert messages given as ``(queue_id, payload, priority,
+        expires_at, available_at)`` rows, all pointing to `broadcast_id` if
+        given.
+
+        With :attr:`raw_sql` the rows are written by prebuilt multi-row
+        INSERT statements, otherwise with ``bulk_create``.
+        """
+        conn = self.connection_for_write()
+        if not self.uses_raw_sql(conn):
+            self.using(conn.alias).bulk_create(
+                [self.model(queue_id=queue_id, payload=payload, priority=priority,
+                            expires_at=expires_at, available_at=available_at,
+                            broadcast_id=broadcast_id)
+                 for queue_id, payload, priority, expires_at, available_at in rows])
+            return
+
+        sent_at = self._db_datetime(conn)
+        with conn.cursor() as cursor:
+            for start in range(0, len(rows), self.insert_batch_size):
+                chunk = rows[start:start + self.insert_batch_size]
+                params = []
+                for queue_id, payload, priority, expires_at, available_at in chunk:
+                    if expires_at is not None:
+                        expires_at = self._db_datetime(conn, expires_at)
+                    if available_at is not None:
+                        available_at = self._db_datetime(conn, available_at)
+                    params.extend((queue_id, payload, priority, sent_at, expires_at,
+                                   available_at, True, broadcast_id))
+                cursor.execute(self._sql(conn, 'insert', len(chunk)), params)
+
+    def _db_datetime(self, conn, value=None):
+        # `value` (default now) as a parameter of the prebuilt statements
+        return self.model._meta.get_field('sent_at').get_db_prep_value(
+            value or timezone.now(), conn)
+
+    def claim(self, queue_ids, limit, round_robin=False):
+        """Claim up to `limit` visible, unexpired messages from any of `queue_ids`,
+        or from all queues if ``None``.
+
+        Returns ``(queue_id, payload)`` pairs in delivery order: highest
+        priority first, then by ``sent_at`` (by ``id`` across all queues).
+        Every queue's messages are found by walking its entries in the
+        claim index, so the backlog of other queues is never read. Where
+        supported, and when `queue_ids` are given, the messages are deleted
+        and returned by one ``DELETE ... RETURNING`` statement. Otherwise see
+        :meth:`_claim`.
+
+        With `round_robin` every queue gets its share of `limit`, rounded
+        up, instead of the oldest messages of all queues being claimed, so
+        a backlog in one queue doesn't hold back the others. Shares cut by
+        `limit` are taken from the last of `queue_ids`, callers rotate them
+        to even that out.
+
+        Delayed messages are only claimed once released, see :meth:`release`.
+        """
+        sink = metrics.sink
+        if sink is not None:
+            time_start = monotonic()
+        if self.release_interval is not None and monotonic() >= MessageManager._release_due:
+            self.release()
+        round_robin = round_robin and queue_ids is not None and len(queue_ids) > 1
+        claimed = None
+        if queue_ids and self.delete_returning:
+            conn = self.connection_for_write()
+            if supports_delete_returning(conn):
+                claimed = self._claim_delete_returning(conn, queue_ids, limit, round_robin)
+        if claimed is None:
+            claimed = self._claim(queue_ids, limit, round_robin)
+        if sink is not None:
+            sink.observe('claim_seconds', monotonic() - time_start)
+        return claimed
+
+    def _claim_delete_returning(self, conn, queue_ids, limit, round_robin=False):
+        # Claimed rows are never redelivered from the table (unacked
+        # messages are restored by publishing them again), so deleting them
+        # right away is equivalent to hiding them and cleaning up later.
+        kind = 'claim_delete_returning_round_robin' if round_robin else 'claim_delete_returning'
+        sql = self._sql(conn, kind, len(queue_ids))
+        with conn.cursor() as cursor:
+            cursor.execute(sql, self._claim_params(conn, queue_ids, limit, round_robin))
+            rows = cursor.fetchall()
+        # RETURNING does not preserve the subquery order
+        rows.sort(key=lambda row: (-row[3], row[4], row[0]))
+        return [(queue_id, payload) for _, queue_id, payload, _, _ in rows]
+
+    def _claim_params(self, conn, queue_ids, limit, round_robin=False):
+        # Parameters of the statements built by _claimable_sql()
+        now = self._db_datetime(conn)
+        if not queue_ids or len(queue_ids) == 1:
+            return tuple(queue_ids or ()) + (True, now, limit)
+        share = queue_share(limit, len(queue_ids)) if round_robin else limit
+        params = []
+        for queue_id in queue_ids:
+            params.extend((queue_id, True, now, share))
+        params.append(limit)
+        return params
 
     @commit_on_success
-    def pop(self):
+    def _claim(self, queue_ids, limit, round_robin=False):
+        """Claim up to `limit` visible messages in a single transaction.
+
+        The oldest visible rows are locked and read in one query and then
+        marked invisible with a single UPDATE by id. With
+        :attr:`skip_locked` concurrent consumers claim disjoint rows instead
+        of queueing up behind the same head row. Invisible rows are left for
+        :meth:`cleanup` to delete.
+        """
+        conn = self.connection_for_write()
+        if self.uses_raw_sql(conn):
+            kind = 'claim_select_round_robin' if round_robin else 'claim_select'
+            sql = self._sql(conn, kind, len(queue_ids or ()))
+            sink = metrics.sink
+            if sink is not None:
+                time_start = monotonic()
+            with conn.cursor() as cursor:
+                cursor.execute(sql, self._claim_params(conn, queue_ids, limit, round_robin))
+                rows = cursor.fetchall()
+                if sink is not None:
+                    sink.observe('claim_lock_seconds', monotonic() - time_start)
+                if rows:
+                    cursor.execute(self._sql(conn, 'hide', len(rows)),
+                                   [False] + [pk for pk, _, _ in rows])
+            return [(queue_id, payload) for _, queue_id, payload in rows]
+
+        resultset = select_for_update(
+            self.filter(visible=True, available_at__isnull=True).exclude(
+                expires_at__lte=timezone.now()),
+            skip_locked=self.skip_locked, conn=conn)
+        columns = ('id', 'queue_id', 'payload', 'broadcast_id')
+        sink = metrics.sink
+        if sink is not None:
+            time_start = monotonic()
+        if queue_ids is None:
+            rows = list(resultset.order_by('-priority', 'id').values_list(*columns)[0:limit])
+        else:
+            # One index seek per queue, see _claimable_sql()
+            share = queue_share(limit, len(queue_ids)) if round_robin else limit
+            resultset = resultset.order_by('-priority', 'sent_at', 'id')
+            rows = []
+            for position, queue_id in enumerate(queue_ids):
+                rows.extend((position if round_robin else 0,) + row
+                            for row in resultset.filter(queue_id=queue_id).values_list(
+                                *columns + ('priority', 'sent_at'))[0:share])
+            rows.sort(key=lambda row: (row[0], -row[5], row[6], row[1]))
+            rows = [row[1:5] for row in rows[0:limit]]
+        if sink is not None:
+            sink.observe('claim_lock_seconds', monotonic() - time_start)
+        if not rows:
+            return []
+
+        self.filter(id__in=[row[0] for row in rows]).update(visible=False)
+        return self._with_payloads(rows)
+
+    def _with_payloads(self, rows):
+        # Turn claimed (id, queue_id, payload, broadcast_id) rows into
+        # (queue_id, payload) pairs, reading the payloads of broadcasts.
+        # The prebuilt statements read them with a subquery instead.
+        broadcast_ids = {row[3] for row in rows if row[3] is not None}
+        if not broadcast_ids:
+            return [(queue_id, payload) for _, queue_id, payload, _ in rows]
+
+        broadcast_model = self.model.broadcast.field.related_model
+        payloads = dict(broadcast_model.objects.filter(
+            id__in=broadcast_ids).values_list('id', 'payload'))
+        return [(queue_id, payload if broadcast_id is None else payloads[broadcast_id])
+                for _, queue_id, payload, broadcast_id in rows]
+
+    def uses_raw_sql(self, conn):
+        """Whether the hot path runs prebuilt SQL on `conn`."""
+        return self.raw_sql and conn.vendor in RAW_SQL_VENDORS
+
+    def _sql(self, conn, kind, count):
+        """Return the statement `kind` for `count` queues or rows.
+
+        Statements are built on first use and cached per connection alias.
+        """
+        key = (conn.alias, kind, count)
         try:
-            resultset = select_for_update(
-                self.filter(visible=True).order_by('sent_at', 'id')
-            )
-            result = resultset[0:1].get()
-            result.visible = False
-            result.save()
-            recv = self.__class__._messages_received
-            recv[0] += 1
-            if not recv[0] % self.cleanup_every:
-                self.cleanup()
-            return result.payload
-        except self.model.DoesNotExist:
-            pass
+            return self._statements[key]
+        except KeyError:
+            sql = self._statements[key] = getattr(self, '_build_%s_sql' % kind)(conn, count)
+            return sql
+
+    def _names(self, conn):
+        opts = self.model._meta
+        qn = conn.ops.quote_name
+        names = {name: qn(opts.get_field(name).column)
+                 for name in ('id', 'queue', 'visible', 'priority', 'sent_at', 'expires_at',
+                              'available_at', 'payload', 'broadcast')}
+        names['table'] = qn(opts.db_table)
+        # The payload of broadcast messages is stored in the broadcast
+        broadcast = opts.get_field('broadcast').related_model._meta
+        # (SQLite 3.40 returns NULL for a CASE with a subquery in RETURNING)
+        names['message_payload'] = (
+            'COALESCE((SELECT {broadcast_table}.{broadcast_payload} FROM {broadcast_table} '
+            'WHERE {broadcast_table}.{broadcast_id} = {table}.{broadcast}), '
+            '{table}.{payload})').format(
+            broadcast_table=qn(broadcast.db_table),
+            broadcast_id=qn(broadcast.pk.column),
+            broadcast_payload=qn(broadcast.get_field('payload').column),
+            **names)
+        return names
+
+    def _claimable_sql(self, conn, queue_count, columns='{id}', merged='{id}', lock='',
+                       round_robin=False):
+        # Oldest visible, available and unexpired messages of the queues,
+        # see claim() for the order. Several queues are claimed from by
+        # one index seek per queue, merged with UNION ALL: a single
+        # `queue IN (...)` would walk the messages of all queues. `merged`
+        # are the names of `columns` in the merged result. With
+        # `round_robin` the seeks are merged in the order of the queues.
+        names = self._names(conn)
+        where = ('{visible} = %s AND {available_at} IS NULL AND '
+                 '({expires_at} IS NULL OR {expires_at} > %s)')
+        order = ' ORDER BY {priority} DESC, {sent_at}, {id} LIMIT %s'
+        if queue_count <= 1:
+            if queue_count:
+                where = '{queue} = %s AND ' + where
+            else:
+                order = ' ORDER BY {priority} DESC, {id} LIMIT %s'
+            return ('SELECT ' + columns + ' FROM {table} WHERE ' + where +
+                    order + lock).format(**names)
+
+        position = conn.ops.quote_name('position')
+        seek = ('SELECT * FROM (SELECT ' + columns + ', {priority}, {sent_at}{position} '
+                'FROM {table} WHERE {queue} = %s AND ' + where + order + lock + ') {alias}')
+        seeks = ' UNION ALL '.join(
+            seek.format(alias=conn.ops.quote_name('claimable%d' % i),
+                        position=', %d AS %s' % (i, position) if round_robin else '',
+                        **names)
+            for i in range(queue_count))
+        if round_robin:
+            order = ' ORDER BY ' + position + ', {priority} DESC, {sent_at}, {id} LIMIT %s'
+        return ('SELECT ' + merged + ' FROM ({seeks}) {alias}' + order).format(
+            seeks=seeks, alias=conn.ops.quote_name('claimable'), **names)
+
+    def _claim_lock(self, conn):
+        # Row locking clause of the claim statements, see skip_locked
+        if not conn.features.has_select_for_update:
+            return ''
+        if self.skip_locked and supports_skip_locked(conn):
+            return ' FOR UPDATE SKIP LOCKED'
+        return ' FOR UPDATE'
+
+    def _build_claim_delete_returning_sql(self, conn, queue_count, round_robin=False):
+        return ('DELETE FROM {table} WHERE {id} IN ({claimable}) '
+                'RETURNING {id}, {queue}, {message_payload}, {priority}, {sent_at}').format(
+            claimable=self._claimable_sql(conn, queue_count, lock=self._claim_lock(conn),
+                                          round_robin=round_robin),
+            **self._names(conn))
+
+    def _build_claim_delete_returning_round_robin_sql(self, conn, queue_count):
+        return self._build_claim_delete_returning_sql(conn, queue_count, round_robin=True)
+
+    def _build_claim_select_sql(self, conn, queue_count, round_robin=False):
+        return self._claimable_sql(conn, queue_count,
+                                   '{id}, {queue}, {message_payload} AS {payload}',
+                                   '{id}, {queue}, {payload}', self._claim_lock(conn),
+                                   round_robin)
+
+    def _build_claim_select_round_robin_sql(self, conn, queue_count):
+        return self._build_claim_select_sql(conn, queue_count, round_robin=True)
+
+    def _build_purge_sql(self, conn, queue_count, delayed=False):
+        if delayed:
+            where = '{queue} = %s AND {available_at} IS NOT NULL'
+        else:
+            where = '{queue} = %s AND {visible} = %s AND {available_at} IS NULL'
+        if conn.vendor == 'mysql':
+            # MySQL can't LIMIT a subquery of the table being deleted from
+            return ('DELETE FROM {table} WHERE ' + where + ' LIMIT %s').format(
+                **self._names(conn))
+        return ('DELETE FROM {table} WHERE {id} IN ('
+                'SELECT {id} FROM {table} WHERE ' + where + ' LIMIT %s)').format(
+            **self._names(conn))
+
+    def _build_purge_delayed_sql(self, conn, queue_count):
+        return self._build_purge_sql(conn, queue_count, delayed=True)
+
+    def _build_hide_sql(self, conn, row_count):
+        return 'UPDATE {table} SET {visible} = %s WHERE {id} IN ({ids})'.format(
+            ids=', '.join(['%s'] * row_count), **self._names(conn))
+
+    def _build_insert_sql(self, conn, row_count):
+        return ('INSERT INTO {table} ({queue}, {payload}, {priority}, {sent_at}, {expires_at}, '
+                '{available_at}, {visible}, {broadcast}) VALUES {rows}').format(
+            rows=', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * row_count),
+            **self._names(conn))
+
+    def purge(self, queue_id, batch_size=None):
+        """Delete all messages of `queue_id` in chunks of up to `batch_size`.
+
+        Every chunk is a single DELETE statement committed on its own, so no
+        rows are loaded and no lock is held for the whole purge. Available
+        messages are found through the claim index, delayed ones through
+        the release index. Returns the number of deleted messages as
+        reported by the database, not counting the consumed messages
+        awaiting :meth:`cleanup`.
+        """
+        batch_size = batch_size or self.purge_batch_size
+        conn = self.connection_for_write()
+        deleted = 0
+        if self.uses_raw_sql(conn):
+            for kind, params, pending in (('purge', (queue_id, True), True),
+                                          ('purge', (queue_id, False), False),
+                                          ('purge_delayed', (queue_id,), True)):
+                sql = self._sql(conn, kind, 1)
+                while 1:
+                    with conn.cursor() as cursor:
+                        cursor.execute(sql, params + (batch_size,))
+                        count = cursor.rowcount
+                    if pending:
+                        deleted += count
+                    if count < batch_size:
+                        break
+            return deleted
+
+        messages = self.using(conn.alias).filter(queue_id=queue_id)
+        for messages, pending in (
+                (messages.filter(visible=True, available_at__isnull=True), True),
+                (messages.filter(visible=False, available_at__isnull=True), False),
+                (messages.filter(available_at__isnull=False), True)):
+            while 1:
+                ids = list(messages.values_list('id', flat=True)[0:batch_size])
+                if not ids:
+                    break
+                count = messages.filter(id__in=ids).delete()[0]
+                if pending:
+                    deleted += count
+        return deleted
+
+    def needs_cleanup(self):
+        """Whether claiming leaves consumed messages behind for :meth:`cleanup`."""
+        return not (self.delete_returning and
+                    supports_delete_returning(self.connection_for_write()))
+
+    def cleanup(self, batch_size=None, queue_ids=None, sent_before=None):
+        """Delete all consumed messages, see :meth:`iter_cleanup`.
+
+        Returns the number of deleted messages.
+        """
+        sink = metrics.sink
+        if sink is not None:
+            time_start = monotonic()
+        deleted = sum(self.iter_cleanup(batch_size, queue_ids, sent_before))
+        if sink is not None:
+            sink.observe('cleanup_seconds', monotonic() - time_start)
+        return deleted
+
+    def iter_cleanup(self, batch_size=None, queue_ids=None, sent_before=None):
+        """Delete consumed messages in chunks of up to `batch_size` rows.
+
+        Chunks are consecutive primary key ranges, each deleted by its own
+        statement and committed separately, so no lock is held for long.
+        Deletion can be restricted to `queue_ids` and to messages sent
+        before the `sent_before` datetime. Yields the number of messages
+        deleted by every chunk.
+        """
+        batch_size = batch_size or self.cleanup_batch_size
+        messages = self.using(self.connection_for_write().alias).filter(visible=False)
+        if queue_ids is not None:
+            messages = messages.filter(queue_id__in=queue_ids)
+        if sent_before is not None:
+            messages = messages.filter(sent_at__lt=sent_before)
+        last_id = None
+        while 1:
+            chunk = messages
+            if last_id is not None:
+                chunk = chunk.filter(id__gt=last_id)
+            ids = list(chunk.order_by('id').values_list('id', flat=True)[0:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            sink = metrics.sink
+            if sink is not None:
+                time_start = monotonic()
+            deleted, _ = messages.filter(id__gte=ids[0], id__lte=last_id).delete()
+            if sink is not None:
+                sink.observe('cleanup_chunk_seconds', monotonic() - time_start)
+                sink.incr('cleaned', deleted)
+            yield deleted
+
+    def release(self):
+        """Make the delayed messages that are due claimable.
+
+        Delayed messages keep their ``available_at`` until released, which
+        keeps them out of the claim index. The due ones are found through
+        ``djkombu_message_available_idx`` and released by one UPDATE. The UPDATE, and with
+        it the write lock on SQLite, is skipped unless an indexed lookup finds
+        a due message. Returns the number of released messages.
+        """
+        MessageManager._release_due = monotonic() + (self.release_interval or 0)
+        due = self.using(self.connection_for_write().alias).filter(
+            available_at__lte=timezone.now())
+        if not due.exists():
+            return 0
+        return due.update(available_at=None)
 
-    def cleanup(self):
-        cursor = self.connection_for_write().cursor()
-        cursor.execute(
-            'DELETE FROM %s WHERE visible=%%s' % (
-                self.model._meta.db_table,),
-            (False,)
-        )
+    def iter_expire(self, batch_size=None, queue_ids=None, sent_before=None):
+        """Delete expired messages in chunks of up to `batch_size` rows,
+        found through the ``expires_at`` index. Deletion can be restricted
+        to `queue_ids` and to messages sent before the `sent_before`
+        datetime. Yields the number of messages deleted by every chunk."""
+        batch_size = batch_size or self.cleanup_batch_size
+        expired = self.using(self.connection_for_write().alias).filter(
+            expires_at__lte=timezone.now())
+        if queue_ids is not None:
+            expired = expired.filter(queue_id__in=queue_ids)
+        if sent_before is not None:
+            expired = expired.filter(sent_at__lt=sent_before)
+        while 1:
+            ids = list(expired.order_by('expires_at').values_list('id', flat=True)[0:batch_size])
+            if not ids:
+                break
+            deleted, _ = expired.filter(id__in=ids).delete()
+            sink = metrics.sink
+            if sink is not None:
+                sink.incr('expired', deleted)
+            yield deleted
 
     def connection_for_write(self):
         if connections:
-            return connections[router.db_for_write(self.model)]
+            return connections[db_alias(self.model)]
         return connection
@@ -0,0 +1,188 @@
+"""Instrumentation of the Django transport.
+
+The transport reports what it is doing to a metrics sink selected with the
+``KOMBU_METRICS`` setting, either an instance or the import path of a sink
+class. Without a sink nothing is measured: call sites only check
+:data:`sink` for ``None``.
+
+A sink implements :class:`MetricsSink`. Metric names are unprefixed, the
+sinks add their own namespace:
+
+=========================  =========  ==========================================
+Name                       Type       Meaning
+=========================  =========  ==========================================
+``published``              counter    messages published, by ``queue``
+``broadcast``              counter    fanout messages published, by ``exchange``
+``polls``                  counter    database fetches by a channel
+``empty_polls``            counter    fetches that returned no message
+``fetched``                counter    messages claimed by fetches
+``fetch_seconds``          histogram  time spent in a fetch
+``claim_seconds``          histogram  time spent claiming in ``MessageManager``
+``claim_lock_seconds``     histogram  time spent locking rows to claim them
+``queue_depth``            gauge      messages waiting, by ``queue``
+``purged``                 counter    messages purged, by ``queue``
+``cleaned``                counter    consumed messages deleted
+``expired``                counter    expired messages deleted
+``cleanup_seconds``        histogram  duration of a cleanup run
+``cleanup_chunk_seconds``  histogram  duration of one deleted chunk
+``notifier_wakeups``       counter    ``drain_events`` woken up by the notifier
+``poll_timeouts``          counter    ``drain_events`` waits that timed out
+=========================  =========  ==========================================
+"""
+from __future__ import absolute_import, unicode_literals
+
+import socket
+from threading import Lock
+
+from kombu.utils import symbol_by_name
+
+#: The configured sink, or ``None`` if instrumentation is disabled.
+sink = None
+
+
+def configure(spec):
+    """Install the sink described by `spec`: a sink instance, the import
+    path of a sink class or ``None`` to disable instrumentation."""
+    global sink
+    if isinstance(spec, str):
+        spec = symbol_by_name(spec)()
+    sink = spec
+    return sink
+
+
+class MetricsSink(object):
+    """Interface of metrics sinks.
+
+    Labels are passed as keyword arguments.
+    """
+
+    def incr(self, name, value=1, **labels):
+        """Add `value` to counter `name`."""
+
+    def observe(self, name, value, **labels):
+        """Record `value` (seconds for timings) in histogram `name`."""
+
+    def gauge(self, name, value, **labels):
+        """Set gauge `name` to `value`."""
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class PrometheusSink(MetricsSink):
+    """Aggregates metrics in memory and renders them in the Prometheus text
+    exposition format with :meth:`render`, e.g. from a metrics view."""
+
+    #: Histogram bucket upper bounds in seconds.
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, namespace='kombu', buckets=None):
+        self.namespace = namespace
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def _name(self, name):
+        return '%s_%s' % (self.namespace, name) if self.namespace else name
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels)
+        return '%s %s' % (name, value)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                name = self._name(name) + '_total'
+                declare(name, 'counter')
+                lines.append(self._format(name, labels, value))
+            for (name, labels), value in sorted(self._gauges.items()):
+                name = self._name(name)
+                declare(name, 'gauge')
+                lines.append(self._format(name, labels, value))
+            for (name, labels), (counts, count, total) in sorted(self._histograms.items()):
+                name = self._name(name)
+                declare(name, 'histogram')
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(self._format(name + '_bucket', labels + (('le', repr(bound)),),
+                                              bucket_count))
+                lines.append(self._format(name + '_bucket', labels + (('le', '+Inf'),), count))
+                lines.append(self._format(name + '_sum', labels, total))
+                lines.append(self._format(name + '_count', labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(MetricsSink):
+    """Sends every metric as a statsd UDP datagram.
+
+    Timings are sent in milliseconds. Labels are sent as DogStatsD tags if
+    `tags` is set and dropped otherwise.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='kombu', tags=False):
+        self.address = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self.tags = tags
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def _send(self, name, value, kind, labels):
+        data = '%s%s:%s|%s' % (self.prefix, name, value, kind)
+        if self.tags and labels:
+            data += '|#' + ','.join('%s:%s' % item for item in sorted(labels.items()))
+        try:
+            self.sock.sendto(data.encode('utf-8'), self.address)
+        except OSError:
+            # Metrics are best effort
+            pass
+
+    def incr(self, name, value=1, **labels):
+        self._send(name, value, 'c', labels)
+
+    def observe(self, name, value, **labels):
+        self._send(name, round(value * 1000, 3), 'ms', labels)
+
+    def gauge(self, name, value, **labels):
+        self._send(name, value, 'g', labels)
+
+    def close(self):
+        self.sock.close()
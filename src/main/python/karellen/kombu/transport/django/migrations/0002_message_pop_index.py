@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['queue', 'visible', 'sent_at', 'id'],
+                name='djkombu_message_pop_idx'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='visible',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sent_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='queue',
+            field=models.ForeignKey(
+                related_name='messages', to='karellen_kombu_transport_django.Queue',
+                on_delete=models.CASCADE, db_index=False),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0002_message_pop_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(
+                    verbose_name='ID', serialize=False,
+                    auto_created=True, primary_key=True)),
+                ('exchange', models.CharField(max_length=200, verbose_name='exchange')),
+                ('sent_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('payload', models.TextField(verbose_name='payload')),
+            ],
+            options={
+                'db_table': 'djkombu_broadcast',
+                'verbose_name': 'broadcast',
+                'verbose_name_plural': 'broadcasts',
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='broadcast',
+            field=models.ForeignKey(
+                related_name='messages', to='karellen_kombu_transport_django.Broadcast',
+                on_delete=models.CASCADE, null=True, blank=True),
+        ),
+        migrations.CreateModel(
+            name='Binding',
+            fields=[
+                ('id', models.AutoField(
+                    verbose_name='ID', serialize=False,
+                    auto_created=True, primary_key=True)),
+                ('exchange', models.CharField(max_length=200, verbose_name='exchange')),
+                ('queue', models.ForeignKey(
+                    related_name='bindings', to='karellen_kombu_transport_django.Queue',
+                    on_delete=models.CASCADE)),
+            ],
+            options={
+                'db_table': 'djkombu_binding',
+                'verbose_name': 'binding',
+                'verbose_name_plural': 'bindings',
+                'unique_together': {('exchange', 'queue')},
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0003_fanout'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Exchange',
+            fields=[
+                ('id', models.AutoField(
+                    verbose_name='ID', serialize=False,
+                    auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=200, unique=True, verbose_name='name')),
+                ('type', models.CharField(default='direct', max_length=32, verbose_name='type')),
+                ('durable', models.BooleanField(default=True)),
+                ('auto_delete', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'djkombu_exchange',
+                'verbose_name': 'exchange',
+                'verbose_name_plural': 'exchanges',
+            },
+        ),
+        migrations.AddField(
+            model_name='binding',
+            name='routing_key',
+            field=models.CharField(blank=True, default='', max_length=255,
+                                   verbose_name='routing key'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='binding',
+            unique_together={('exchange', 'queue', 'routing_key')},
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0004_exchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='djkombu_message_pop_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['queue', 'visible', '-priority', 'sent_at', 'id'],
+                name='djkombu_message_pop_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['-priority', 'id'],
+                name='djkombu_message_priority_idx'),
+        ),
+    ]
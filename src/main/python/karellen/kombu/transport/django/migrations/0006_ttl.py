@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0005_message_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='message_ttl',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='expires',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='expires_at',
+            field=models.DateTimeField(null=True, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='expires_at',
+            field=models.DateTimeField(null=True, blank=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karellen_kombu_transport_django', '0006_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='available_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='djkombu_message_pop_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='djkombu_message_priority_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['queue', 'visible', '-priority', 'sent_at', 'id'],
+                name='djkombu_message_pop_idx',
+                condition=Q(available_at=None)),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['visible', '-priority', 'id'],
+                name='djkombu_message_priority_idx',
+                condition=Q(available_at=None)),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['available_at', 'queue'],
+                name='djkombu_message_available_idx',
+                condition=Q(available_at__isnull=False)),
+        ),
+    ]
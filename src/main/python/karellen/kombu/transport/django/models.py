@@ -3,13 +3,22 @@ from __future__ import absolute_import, unicode_literals
 import django
 
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_delete
 from django.utils.translation import ugettext_lazy as _
 
-from .managers import QueueManager, MessageManager
+from .managers import (QueueManager, MessageManager, ExchangeManager, BindingManager,
+                       BroadcastManager)
 
 
 class Queue(models.Model):
     name = models.CharField(_('name'), max_length=200, unique=True)
+    #: ``x-message-ttl`` in milliseconds.
+    message_ttl = models.PositiveIntegerField(null=True, blank=True)
+    #: ``x-expires`` in milliseconds, the queue is deleted after
+    #: :attr:`expires_at` unless it is used before.
+    expires = models.PositiveIntegerField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     objects = QueueManager()
 
@@ -21,13 +30,78 @@ class Queue(models.Model):
         verbose_name_plural = _('queues')
 
 
+class Exchange(models.Model):
+    """Exchange declared by any process, so that clients don't have to
+    redeclare it."""
+    name = models.CharField(_('name'), max_length=200, unique=True)
+    type = models.CharField(_('type'), max_length=32, default='direct')
+    durable = models.BooleanField(default=True)
+    auto_delete = models.BooleanField(default=False)
+
+    objects = ExchangeManager()
+
+    class Meta:
+        if django.VERSION >= (1, 7):
+            app_label = 'karellen_kombu_transport_django'
+        db_table = 'djkombu_exchange'
+        verbose_name = _('exchange')
+        verbose_name_plural = _('exchanges')
+
+
+class Binding(models.Model):
+    """Binding of a queue to an exchange, shared by all processes."""
+    exchange = models.CharField(_('exchange'), max_length=200)
+    queue = models.ForeignKey(Queue, related_name='bindings', on_delete=models.CASCADE)
+    routing_key = models.CharField(_('routing key'), max_length=255, blank=True, default='')
+
+    objects = BindingManager()
+
+    class Meta:
+        if django.VERSION >= (1, 7):
+            app_label = 'karellen_kombu_transport_django'
+        db_table = 'djkombu_binding'
+        unique_together = (('exchange', 'queue', 'routing_key'),)
+        verbose_name = _('binding')
+        verbose_name_plural = _('bindings')
+
+
+class Broadcast(models.Model):
+    """Payload of a message published to a fanout exchange.
+
+    Every queue bound to the exchange gets a :class:`Message` pointing to
+    the broadcast instead of a copy of the payload.
+    """
+    exchange = models.CharField(_('exchange'), max_length=200)
+    sent_at = models.DateTimeField(null=True, blank=True, auto_now_add=True)
+    payload = models.TextField(_('payload'), null=False)
+
+    objects = BroadcastManager()
+
+    class Meta:
+        if django.VERSION >= (1, 7):
+            app_label = 'karellen_kombu_transport_django'
+        db_table = 'djkombu_broadcast'
+        verbose_name = _('broadcast')
+        verbose_name_plural = _('broadcasts')
+
+
 class Message(models.Model):
-    visible = models.BooleanField(default=True, db_index=True)
-    sent_at = models.DateTimeField(null=True, blank=True, db_index=True,
-                                   auto_now_add=True)
+    visible = models.BooleanField(default=True)
+    #: Messages with a higher priority are delivered first.
+    priority = models.PositiveSmallIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True, auto_now_add=True)
+    #: Expired messages are skipped by consumers and deleted by the reaper.
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    #: Delayed messages are claimed once due and released, see
+    #: :meth:`~karellen.kombu.transport.django.managers.MessageManager.release`,
+    #: which finds them through ``djkombu_message_available_idx``.
+    available_at = models.DateTimeField(null=True, blank=True)
     payload = models.TextField(_('payload'), null=False)
     queue = models.ForeignKey(Queue, related_name='messages',
-                              on_delete=models.CASCADE)
+                              on_delete=models.CASCADE, db_index=False)
+    #: Set for fanout deliveries, whose payload is left empty.
+    broadcast = models.ForeignKey(Broadcast, related_name='messages', null=True, blank=True,
+                                  on_delete=models.CASCADE)
 
     objects = MessageManager()
 
@@ -37,3 +111,29 @@ class Message(models.Model):
         db_table = 'djkombu_message'
         verbose_name = _('message')
         verbose_name_plural = _('messages')
+        if django.VERSION >= (1, 11):
+            # The claim indexes hold available messages only, by queue and
+            # visible, ordered by priority, sent_at, id, and across all
+            # queues by visible, ordered by priority, id: claimed and delayed
+            # messages are never walked. The release index holds delayed
+            # messages only. Backends without partial indexes (MySQL, Oracle)
+            # index all messages.
+            indexes = [
+                models.Index(fields=['queue', 'visible', '-priority', 'sent_at', 'id'],
+                             name='djkombu_message_pop_idx',
+                             condition=Q(available_at=None)),
+                models.Index(fields=['visible', '-priority', 'id'],
+                             name='djkombu_message_priority_idx',
+                             condition=Q(available_at=None)),
+                models.Index(fields=['available_at', 'queue'],
+                             name='djkombu_message_available_idx',
+                             condition=Q(available_at__isnull=False)),
+            ]
+
+
+def forget_deleted_queue(sender, instance, **kwargs):
+    Queue.objects.forget(instance.name)
+    Binding.objects.forget(instance.name)
+
+
+post_delete.connect(forget_deleted_queue, sender=Queue)
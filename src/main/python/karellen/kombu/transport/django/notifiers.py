@@ -0,0 +1,188 @@
+"""Wakeup notifiers used by the Django transport to interrupt polling.
+
+A notifier is created per :class:`~karellen.kombu.transport.django.Transport`
+and behaves like a :class:`threading.Event`: ``drain_events`` waits on it
+between polls and a commit that inserted messages sets it. Notifiers are
+selected with the ``KOMBU_NOTIFIER`` setting.
+
+Notifiers are created with the names of the queues the transport consumes
+from, a live container that is updated as consumers come and go. Wakeups
+naming only other queues are ignored.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import os
+import select
+import socket
+import tempfile
+import weakref
+from itertools import count
+from threading import Event
+
+from kombu.five import monotonic
+
+
+class EventNotifier(Event):
+    """In-process notifier.
+
+    Only commits made by the same process wake the transport up.
+    """
+
+    def __init__(self, database=None, queues=None):
+        super(EventNotifier, self).__init__()
+
+    @classmethod
+    def broadcast(cls, database, queues=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _close_socket(sock, path):
+    sock.close()
+    _unlink(path)
+    try:
+        # Only removed once the last notifier of the database is gone
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+class SocketNotifier(object):
+    """Cross-process notifier based on Unix domain datagram sockets.
+
+    Every notifier binds a socket in a directory shared by all processes
+    using the same database file. :meth:`broadcast` sends a datagram to every
+    socket in that directory, so a commit in one process wakes up transports
+    waiting in any other. The datagram names the queues published to, and
+    receivers not consuming from any of them keep waiting. In-memory databases
+    are process-local and only use the notifier's own socket.
+
+    The socket, and the directory once empty, are removed by :meth:`close`.
+    """
+
+    #: Datagrams naming more queues than fit are sent empty, waking everyone.
+    max_datagram_size = 4096
+
+    #: Base directory for the per-database socket directories.
+    #: Defaults to the system temporary directory.
+    base_dir = None
+
+    _ids = count(1)
+
+    def __init__(self, database=None, queues=None):
+        self.queues = queues
+        self._set = False
+        self.dir = self.socket_dir(database)
+        self.path = os.path.join(self.dir, '%d-%d' % (os.getpid(), next(self._ids)))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            _unlink(self.path)
+            while 1:
+                try:
+                    os.mkdir(self.dir, 0o700)
+                except FileExistsError:
+                    pass
+                try:
+                    sock.bind(self.path)
+                    break
+                except FileNotFoundError:
+                    # Removed meanwhile by the last notifier closing
+                    pass
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self._finalizer = weakref.finalize(self, _close_socket, sock, self.path)
+
+    @classmethod
+    def socket_dir(cls, database):
+        """Path of the socket directory shared by the notifiers of `database`."""
+        if not database or database == ':memory:' or database.startswith('file::memory:'):
+            key = 'pid-%d' % os.getpid()
+        else:
+            key = hashlib.sha1(os.path.realpath(database).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cls.base_dir or tempfile.gettempdir(), 'karellen-kombu-' + key)
+
+    @classmethod
+    def broadcast(cls, database, queues=None):
+        """Wake up the notifiers of `database` consuming from any of
+        `queues`, or all of them if not given."""
+        data = '\n'.join(queues).encode('utf-8') if queues else b''
+        if len(data) > cls.max_datagram_size:
+            data = b''
+        path = cls.socket_dir(database)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            # No notifier is open
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            for name in names:
+                cls._send(sock, os.path.join(path, name), data)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _send(sock, path, data=b''):
+        try:
+            sock.sendto(data, path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # The owning process is gone
+            _unlink(path)
+        except BlockingIOError:
+            # The receiver already has wakeups queued up
+            pass
+
+    def set(self):
+        self._send(self.sock, self.path)
+
+    def wait(self, timeout=None):
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        while not self._set:
+            if self.sock.fileno() < 0:
+                # Closed
+                return True
+            if not select.select([self.sock], [], [], timeout)[0]:
+                break
+            self._receive()
+            if timeout is not None:
+                timeout = max(deadline - monotonic(), 0)
+        return self._set
+
+    def _receive(self):
+        # Read all queued datagrams, setting the notifier if any of them
+        # concerns the consumed queues
+        queues = self.queues
+        while 1:
+            try:
+                data = self.sock.recv(self.max_datagram_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # Closed while waiting
+                self._set = True
+                break
+            if not data or queues is None or \
+                    not set(data.decode('utf-8').split('\n')).isdisjoint(queues):
+                self._set = True
+
+    def clear(self):
+        self._receive()
+        self._set = False
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,117 @@
+"""Background deletion of consumed and expired messages.
+
+Backends that can't claim messages with ``DELETE ... RETURNING`` only hide
+claimed messages. The reaper deletes them outside of the consumers' hot path,
+in bounded chunks with a pause between chunks, followed by expired messages
+and the fanout broadcasts all of whose messages were consumed. Queues unused
+for longer than their ``x-expires`` are deleted first.
+
+Every consuming process runs a reaper. Their rounds are spread out by a
+random jitter, so they don't all hit the database at the same time.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from itertools import chain
+from random import uniform
+from threading import Event, Lock, Thread
+
+from kombu.five import monotonic
+from kombu.log import get_logger
+
+from . import metrics
+
+logger = get_logger(__name__)
+
+_reaper = None
+_reaper_lock = Lock()
+
+
+class MessageReaper(Thread):
+    """Thread deleting consumed messages every `interval` seconds.
+
+    Progress is exposed through :attr:`progress`.
+    """
+
+    #: Every wait is randomly shortened or lengthened by up to this
+    #: fraction of `interval`.
+    jitter = 0.5
+
+    def __init__(self, interval, batch_size=None, pause=0):
+        super(MessageReaper, self).__init__(name='karellen-kombu-reaper')
+        self.daemon = True
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.runs = 0
+        self.deleted = 0
+        self.last_deleted = 0
+        self.last_duration = None
+        self.running = False
+        self._shutdown = Event()
+
+    @property
+    def progress(self):
+        return {
+            'running': self.running,
+            'runs': self.runs,
+            'deleted': self.deleted,
+            'last_deleted': self.last_deleted,
+            'last_duration': self.last_duration,
+        }
+
+    def run(self):
+        from karellen.kombu.transport.django.models import Message
+
+        while not self._shutdown.wait(self.interval * uniform(1 - self.jitter, 1 + self.jitter)):
+            try:
+                self.reap()
+            except Exception:
+                # Retry on the next round, e.g. the database was unavailable
+                logger.exception('Failed to delete consumed and expired messages')
+            finally:
+                # Don't hold on to this thread's connection while idle
+                Message.objects.connection_for_write().close()
+
+    def reap(self):
+        from karellen.kombu.transport.django.models import Broadcast, Message, Queue
+
+        time_start = monotonic()
+        self.running = True
+        self.last_deleted = 0
+        try:
+            Queue.objects.expire()
+            # Consumed and expired messages first, they may be the last ones
+            # pointing to a broadcast
+            for deleted in chain(Message.objects.iter_cleanup(self.batch_size),
+                                 Message.objects.iter_expire(self.batch_size),
+                                 Broadcast.objects.iter_cleanup(self.batch_size)):
+                self.last_deleted += deleted
+                self.deleted += deleted
+                if self._shutdown.wait(self.pause):
+                    break
+        finally:
+            self.running = False
+            self.runs += 1
+            self.last_duration = monotonic() - time_start
+            sink = metrics.sink
+            if sink is not None:
+                sink.observe('cleanup_seconds', self.last_duration)
+        return self.last_deleted
+
+    def stop(self):
+        self._shutdown.set()
+
+
+def ensure_reaper(interval, batch_size=None, pause=0):
+    """Start the process-wide reaper unless it is already running."""
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None or not _reaper.is_alive():
+            _reaper = MessageReaper(interval, batch_size, pause)
+            _reaper.start()
+        return _reaper
+
+
+def get_reaper():
+    """Return the process-wide reaper, if one was started."""
+    return _reaper
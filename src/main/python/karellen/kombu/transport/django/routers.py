@@ -0,0 +1,48 @@
+"""Database router keeping the transport tables in a dedicated database.
+
+Add it to ``DATABASE_ROUTERS`` together with ``KOMBU_DATABASE_ALIAS``::
+
+    DATABASES = {
+        'default': {...},
+        'kombu': {...},
+    }
+    DATABASE_ROUTERS = ['karellen.kombu.transport.django.routers.KombuRouter']
+    KOMBU_DATABASE_ALIAS = 'kombu'
+
+so that migrations, admin and any other code going through the routers agree
+with the transport, which sends its own queries to ``KOMBU_DATABASE_ALIAS``
+directly.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+
+APP_LABEL = 'karellen_kombu_transport_django'
+
+
+class KombuRouter(object):
+    """Routes the transport models to ``KOMBU_DATABASE_ALIAS``.
+
+    Models of other applications are left to the remaining routers.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'KOMBU_DATABASE_ALIAS', None) or 'default'
+
+    def _is_kombu(self, model):
+        return model._meta.app_label == APP_LABEL
+
+    def db_for_read(self, model, **hints):
+        if self._is_kombu(model):
+            return self.alias
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        kombu1, kombu2 = self._is_kombu(obj1), self._is_kombu(obj2)
+        if kombu1 or kombu2:
+            return kombu1 and kombu2
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == APP_LABEL:
+            return db == self.alias
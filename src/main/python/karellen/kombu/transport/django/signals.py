@@ -0,0 +1,7 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.dispatch import Signal
+
+#: Sent right before messages are inserted, with the names of the
+#: ``queues`` receiving them and the database alias (``using``) written to.
+pre_publish = Signal()
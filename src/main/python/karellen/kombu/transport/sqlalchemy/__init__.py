@@ -0,0 +1,251 @@
+"""Kombu transport using SQLAlchemy Core as the message store."""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from collections import deque
+
+from kombu.five import Empty
+from kombu.transport import virtual
+from kombu.utils import cached_property
+from kombu.utils.encoding import bytes_to_str
+from kombu.utils.json import loads, dumps
+from sqlalchemy import bindparam, create_engine, delete, func, select, true
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from karellen.kombu.buffering import BufferingChannelMixin
+
+from .models import define_tables
+
+VERSION = (1, 0, 0)
+__version__ = '.'.join(map(str, VERSION))
+
+_MUTEX = threading.RLock()
+_stores = {}
+
+
+def get_store(url, queue_tablename, message_tablename, engine_options=None):
+    """Return the :class:`MessageStore` shared by all channels using the
+    same database `url`, tables and engine options."""
+    engine_options = engine_options or {}
+    key = (url, queue_tablename, message_tablename, repr(sorted(engine_options.items())))
+    store = _stores.get(key)
+    if store is None:
+        with _MUTEX:
+            store = _stores.get(key)
+            if store is None:
+                engine = create_engine(url, **engine_options)
+                store = _stores[key] = MessageStore(engine, queue_tablename, message_tablename)
+    return store
+
+
+class MessageStore(object):
+    """Engine, tables and statements for one database.
+
+    All statements are built once with bound parameters, so the engine
+    compiles each of them only once and then takes them from its compiled
+    cache. Every operation checks a connection out of the engine's pool for
+    a single transaction.
+    """
+
+    def __init__(self, engine, queue_tablename, message_tablename):
+        self.engine = engine
+        self.queue, self.message = define_tables(queue_tablename, message_tablename)
+        self.queue.metadata.create_all(engine)
+        self._queue_ids = {}
+        self._build_statements()
+
+    def _build_statements(self):
+        queue, message = self.queue, self.message
+        dialect = self.engine.dialect
+
+        #: Claim with a single ``DELETE ... RETURNING`` statement
+        self.delete_returning = (dialect.name == 'postgresql' or
+                                 (dialect.name == 'sqlite' and
+                                  getattr(dialect, 'delete_returning', False)))
+        skip_locked = dialect.name == 'postgresql' or (
+            dialect.name == 'mysql' and not getattr(dialect, 'is_mariadb', False) and
+            (dialect.server_version_info or ()) >= (8,))
+
+        self.select_queue_id = select(queue.c.id).where(queue.c.name == bindparam('name'))
+        self.insert_queue = queue.insert()
+        self.insert_messages = message.insert().values(
+            visible=True, version=1, timestamp=func.now())
+
+        claimable = select(message.c.id).where(
+            message.c.queue_id.in_(bindparam('queue_ids', expanding=True)),
+            message.c.visible == true(),
+        ).order_by(message.c.id).limit(bindparam('limit'))
+        if self.delete_returning:
+            if skip_locked:
+                claimable = claimable.with_for_update(skip_locked=True)
+            self.claim_messages = delete(message).where(
+                message.c.id.in_(claimable.scalar_subquery())
+            ).returning(message.c.id, message.c.queue_id, message.c.payload)
+        else:
+            self.claim_messages = claimable.add_columns(
+                message.c.queue_id, message.c.payload
+            ).with_for_update(skip_locked=skip_locked)
+            self.delete_messages = delete(message).where(
+                message.c.id.in_(bindparam('ids', expanding=True)))
+
+        self.count_messages = select(func.count()).select_from(message).where(
+            message.c.queue_id == bindparam('queue_id'),
+            message.c.visible == true())
+        self.purge_messages = delete(message).where(
+            message.c.queue_id == bindparam('queue_id'))
+
+    def queue_id(self, name, create=False):
+        """Return the primary key of queue `name`, creating the queue if
+        `create` is set. Returns ``None`` for unknown queues otherwise."""
+        queue_id = self._queue_ids.get(name)
+        if queue_id is None:
+            with self.engine.begin() as conn:
+                queue_id = conn.execute(self.select_queue_id, {'name': name}).scalar()
+            if queue_id is None and create:
+                try:
+                    with self.engine.begin() as conn:
+                        queue_id = conn.execute(
+                            self.insert_queue, {'name': name}).inserted_primary_key[0]
+                except IntegrityError:
+                    # Created concurrently
+                    with self.engine.begin() as conn:
+                        queue_id = conn.execute(self.select_queue_id, {'name': name}).scalar()
+            if queue_id is not None:
+                self._queue_ids[name] = queue_id
+        return queue_id
+
+    def publish_many(self, queue_payloads):
+        """Insert the payloads of a ``{queue_name: [payload, ...]}`` mapping
+        with one multi-row INSERT."""
+        rows = [{'queue_id': queue_id, 'payload': payload}
+                for queue_id, payloads in ((self.queue_id(name, create=True), payloads)
+                                           for name, payloads in queue_payloads.items())
+                for payload in payloads]
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(self.insert_messages, rows)
+
+    def claim(self, queue_names, limit):
+        """Remove up to `limit` of the oldest messages of `queue_names` and
+        return them as ``(queue_name, payload)`` pairs in publishing order."""
+        names = {}
+        for name in queue_names:
+            queue_id = self.queue_id(name)
+            if queue_id is not None:
+                names[queue_id] = name
+        if not names:
+            return []
+
+        params = {'queue_ids': list(names), 'limit': limit}
+        with self.engine.begin() as conn:
+            rows = conn.execute(self.claim_messages, params).all()
+            if rows and not self.delete_returning:
+                conn.execute(self.delete_messages, {'ids': [row[0] for row in rows]})
+        rows.sort()
+        return [(names[queue_id], payload) for _, queue_id, payload in rows]
+
+    def size(self, name):
+        queue_id = self.queue_id(name)
+        if queue_id is None:
+            return 0
+        with self.engine.begin() as conn:
+            return conn.execute(self.count_messages, {'queue_id': queue_id}).scalar()
+
+    def purge(self, name):
+        queue_id = self.queue_id(name)
+        if queue_id is None:
+            return 0
+        with self.engine.begin() as conn:
+            return conn.execute(self.purge_messages, {'queue_id': queue_id}).rowcount
+
+
+class Channel(BufferingChannelMixin, virtual.Channel):
+    """The channel class."""
+
+    queue_tablename = 'kombu_queue'
+    message_tablename = 'kombu_message'
+
+    #: Keyword arguments for :func:`~sqlalchemy.create_engine`, e.g. the
+    #: pool size. Channels with the same URL and options share one engine.
+    engine_options = None
+
+    from_transport_options = (
+        virtual.Channel.from_transport_options +
+        BufferingChannelMixin.buffering_transport_options +
+        ('queue_tablename', 'message_tablename', 'engine_options')
+    )
+
+    @cached_property
+    def store(self):
+        return get_store(self.connection.client.hostname, self.queue_tablename,
+                         self.message_tablename, self.engine_options)
+
+    def _new_queue(self, queue, **kwargs):
+        self.store.queue_id(queue, create=True)
+
+    def _put(self, queue, message, **kwargs):
+        if self.publish_batch_size <= 1 or self.closed:
+            self.store.publish_many({queue: [dumps(message)]})
+            return
+
+        self._buffer_put(queue, dumps(message))
+
+    def _put_many(self, queue_items):
+        self.store.publish_many(queue_items)
+
+    def _fetch(self, queues):
+        self._flush_put_buffer()
+        claimed = self.store.claim(queues, self._fetch_limit())
+        for queue, payload in claimed:
+            self._fetched.setdefault(queue, deque()).append(payload)
+        return claimed
+
+    def _get(self, queue):
+        if not self._fetched.get(queue):
+            self._fetch([queue])
+        fetched = self._fetched.get(queue)
+        if fetched:
+            return loads(bytes_to_str(fetched.popleft()))
+        raise Empty()
+
+    def _get_many(self, queues, timeout=None):
+        queue = self._next_fetched(queues)
+        if queue is None:
+            if not self._fetch(queues):
+                raise Empty()
+            queue = self._next_fetched(queues)
+        message = loads(bytes_to_str(self._fetched[queue].popleft()))
+        self.connection._deliver(message, queue)
+
+    def _size(self, queue):
+        self._flush_put_buffer()
+        return self.store.size(queue)
+
+    def _purge(self, queue):
+        self._flush_put_buffer()
+        fetched = self._fetched.pop(queue, None)
+        count = self.store.purge(queue)
+        if fetched:
+            count += len(fetched)
+        return count
+
+
+class Transport(virtual.Transport):
+    """The transport class."""
+
+    Channel = Channel
+
+    can_parse_url = True
+    default_port = 0
+    driver_type = 'sql'
+    driver_name = 'sqlalchemy'
+    connection_errors = (OperationalError,)
+
+    def drain_events(self, connection, timeout=None):
+        for channel in self.channels:
+            channel._flush_put_buffer()
+        return super(Transport, self).drain_events(connection, timeout=timeout)
+
+    def driver_version(self):
+        import sqlalchemy
+        return sqlalchemy.__version__
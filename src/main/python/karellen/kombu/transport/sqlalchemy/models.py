@@ -0,0 +1,47 @@
+"""Tables of the SQLAlchemy transport.
+
+The tables are defined with SQLAlchemy Core, the transport never creates ORM
+instances. The layout is compatible with the tables created by the former
+Kombu SQLAlchemy transport.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from sqlalchemy import (Column, Integer, String, Text, DateTime, Sequence,
+                        Boolean, ForeignKey, SmallInteger, Index, MetaData, Table)
+
+TABLE_ARGS = {'sqlite_autoincrement': True, 'mysql_engine': 'InnoDB'}
+
+
+def define_tables(queue_tablename='kombu_queue', message_tablename='kombu_message',
+                  metadata=None):
+    """Define the queue and message tables in `metadata`.
+
+    Returns a ``(queue, message)`` pair of :class:`~sqlalchemy.Table`.
+    """
+    if metadata is None:
+        metadata = MetaData()
+
+    queue = Table(
+        queue_tablename, metadata,
+        Column('id', Integer, Sequence('queue_id_sequence'), primary_key=True,
+               autoincrement=True),
+        Column('name', String(200), unique=True),
+        **TABLE_ARGS
+    )
+
+    message = Table(
+        message_tablename, metadata,
+        Column('id', Integer, Sequence('message_id_sequence'), primary_key=True,
+               autoincrement=True),
+        Column('visible', Boolean, default=True),
+        Column('timestamp', DateTime, nullable=True),
+        Column('payload', Text, nullable=False),
+        Column('version', SmallInteger, nullable=False, default=1),
+        Column('queue_id', Integer,
+               ForeignKey('%s.id' % queue_tablename, name='FK_kombu_message_queue')),
+        # Serves claiming the oldest messages of a queue without a sort
+        Index('ix_%s_queue_id_id' % message_tablename, 'queue_id', 'id'),
+        **TABLE_ARGS
+    )
+
+    return queue, message